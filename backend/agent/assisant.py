@@ -1,15 +1,56 @@
 import json
-from typing import List, Dict, Callable, TypeVar, Generic
-from dataclasses import dataclass
+import time
+import uuid
+import asyncio
+import inspect
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+from typing import Any, List, Dict, Callable, Optional, Tuple, TypeVar, Generic
+from dataclasses import dataclass, field
 
-from haystack.dataclasses import ChatMessage
+from haystack.dataclasses import ChatMessage, StreamingChunk
 from haystack.components.generators.chat import OpenAIChatGenerator
+from openai import OpenAI
 
 from schema.model import Questionnaire, Workout
+from schema.param import PlanningMode
+from storage.repository import WorkoutRepository
+from agent.plan_cache import PlanCache
+from agent.context import ContextWindow, compact_exercise_groups, compact_json, minimize_schema
+from agent.structured import StructuredOutputError, parse_workout, questionnaire_queries, workout_response_format
+from observability.metrics import CONTEXT_TOKENS, LLM_TURNS, STAGE_SECONDS, TOOL_CALL_SECONDS, record_token_usage, timed
 
 
 T = TypeVar("T")
 
+logger = logging.getLogger(__name__)
+
+EventCallback = Callable[[str, Any], None]
+
+
+class WorkoutNotCreatedError(RuntimeError):
+    """The agent finished without persisting a workout; the message holds its last reply"""
+
+
+@dataclass
+class AgentRun:
+    user_id: str
+    # workouts stored under a run id are upserted, so a run stores at most one however often it calls add_workout;
+    # runs planned without one get a fresh id
+    run_id: Optional[str] = None
+    workouts: List[Tuple[str, Workout]] = field(default_factory=list)
+
+    def __post_init__(self):
+        if self.run_id is None:
+            self.run_id = uuid.uuid4().hex
+
+
+# the run being planned, so tools can report what they persisted
+current_run: ContextVar[Optional[AgentRun]] = ContextVar("current_run", default=None)
+
 
 @dataclass
 class FuncTool(Generic[T]):
@@ -17,69 +58,232 @@ class FuncTool(Generic[T]):
     desc: str
     func: Callable[..., T]
     params: Dict
+    event: Optional[str] = None
+    # shrinks the result before it is sent back to the model, events still get the full result
+    compact: Optional[Callable[[T], Any]] = None
+    is_async: bool = field(init=False)
+
+    def __post_init__(self):
+        self.is_async = inspect.iscoroutinefunction(self.func) or inspect.iscoroutinefunction(
+            getattr(self.func, "__call__", None))
+
+
+class _StreamCollector:
+    """Forwards streamed tokens to the event loop and rebuilds streamed tool calls by their index."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_event: EventCallback):
+        self.loop = loop
+        self.on_event = on_event
+        self.tool_calls: Dict[int, Dict] = {}
+
+    def __call__(self, chunk: StreamingChunk):
+        if chunk.content:
+            self.loop.call_soon_threadsafe(self.on_event, "token", chunk.content)
+        for delta in chunk.meta.get("tool_calls") or []:
+            call = self.tool_calls.setdefault(delta.index, {
+                "id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            call["id"] = delta.id or call["id"]
+            if delta.function:
+                call["function"]["name"] += delta.function.name or ""
+                call["function"]["arguments"] += delta.function.arguments or ""
 
 
 class WorkoutAssistantAgent:
-    tool_mapping: Dict[str, Callable]
+    tools: Dict[str, FuncTool]
     tool_schema: List[Dict]
     llm: OpenAIChatGenerator
+    executor: ThreadPoolExecutor
 
-    def __init__(self, tools: List[FuncTool]):
-        self.tool_mapping = {
-            tool.name: tool.func for tool in tools
+    def __init__(self, tools: List[FuncTool], max_turns: int = 3, max_workers: int = 8,
+                 plan_cache: Optional[PlanCache] = None, context: Optional[ContextWindow] = None,
+                 retrieve: Optional[Callable[[List[str]], Dict[str, List[str]]]] = None,
+                 workouts: Optional[WorkoutRepository] = None, max_repairs: int = 1,
+                 planning_mode: PlanningMode = PlanningMode.AGENT, openai_client: Optional[OpenAI] = None):
+        self.tools = {
+            tool.name: tool for tool in tools
         }
         self.tool_schema = [{
             "type": "function",
             "function": {
                 "name": tool.name,
                 "description": tool.desc,
-                "parameters": tool.params,
+                "parameters": minimize_schema(tool.params),
             }
         }
             for tool in tools]
+        self.context = context or ContextWindow()
+        full_schema_tokens = self.context.count_tokens(json.dumps([
+            {"type": "function", "function": {"name": tool.name, "description": tool.desc, "parameters": tool.params}}
+            for tool in tools]))
+        self.tool_schema_tokens = self.context.count_tokens(json.dumps(self.tool_schema))
+        self.tool_schema_tokens_saved = full_schema_tokens - self.tool_schema_tokens
 
         self.instructions = ChatMessage.from_system("""
             You are an AI fitness assistant equipped with specialized tools to plan, create, and update workouts, as well as provide fitness-related advice tailored to user needs.
         """)
         self.llm = OpenAIChatGenerator()
+        if openai_client:
+            # share the rate limited client instead of the generator's own
+            self.llm.client = openai_client
+        self.max_turns = max_turns
+        self.plan_cache = plan_cache
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="agent")
+        # single-shot structured planning
+        self.retrieve = retrieve
+        self.workouts = workouts
+        self.max_repairs = max_repairs
+        self.planning_mode = planning_mode
+        self.response_format = workout_response_format()
+
+    async def _generate(self, messages: List[ChatMessage], on_event: Optional[EventCallback] = None,
+                        generation_kwargs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        collector = _StreamCollector(loop, on_event) if on_event else None
+        started = time.perf_counter()
+        # executor threads do not inherit the caller's context, which carries the trace id
+        response = await loop.run_in_executor(self.executor, partial(
+            contextvars.copy_context().run, self.llm.run,
+            messages=messages, streaming_callback=collector,
+            generation_kwargs=generation_kwargs or {"tools": self.tool_schema}))
+        STAGE_SECONDS.labels(stage="llm_turn").observe(time.perf_counter() - started)
+        record_token_usage(response["replies"][0].meta)
+        if collector and collector.tool_calls:
+            # haystack merges streamed tool call deltas positionally, which garbles parallel calls
+            response["replies"][0].content = json.dumps(
+                [collector.tool_calls[index] for index in sorted(collector.tool_calls)])
+        return response
+
+    async def _call_tool(self, func_call: Dict, on_event: Optional[EventCallback] = None) -> ChatMessage:
+        func_name = func_call["function"]["name"]
+        func_args = json.loads(func_call["function"]["arguments"])
+        tool = self.tools[func_name]
+        if on_event:
+            on_event("tool_call", {"name": func_name, "arguments": func_args})
+        started = time.perf_counter()
+        if tool.is_async:
+            func_response = await tool.func(**func_args)
+        else:
+            loop = asyncio.get_running_loop()
+            func_response = await loop.run_in_executor(self.executor, partial(
+                contextvars.copy_context().run, tool.func, **func_args))
+        TOOL_CALL_SECONDS.labels(tool=func_name).observe(time.perf_counter() - started)
+
+        logger.debug("%s returned %s", func_name, func_response)
+        if on_event and tool.event:
+            on_event(tool.event, func_response)
+        full_content = json.dumps(func_response)
+        content = compact_json(tool.compact(func_response) if tool.compact else func_response)
+        message = ChatMessage.from_function(content=content, name=func_name)
+        message.meta["tokens_saved"] = self.context.count_tokens(full_content) - self.context.count_tokens(content)
+        return message
 
-    async def chat(self, message: str, memory: List[ChatMessage]) -> ChatMessage:
+    async def chat(self, message: str, memory: List[ChatMessage], on_event: Optional[EventCallback] = None) -> ChatMessage:
+        kept_memory = self.context.fit_memory(memory)
+        memory_tokens_saved = self.context.count_all(memory) - self.context.count_all(kept_memory)
         holistic_view = [self.instructions, *
-                         memory, ChatMessage.from_user(message)]
-        response = self.llm.run(messages=holistic_view, generation_kwargs={
-                                "tools": self.tool_schema})
+                         kept_memory, ChatMessage.from_user(message)]
+        sent, saved = 0, 0
 
-        turn=3
+        async def generate():
+            nonlocal sent, saved
+            sent += self.context.count_all(holistic_view) + self.tool_schema_tokens
+            saved += self.tool_schema_tokens_saved + memory_tokens_saved + sum(
+                seen.meta.get("tokens_saved", 0) for seen in holistic_view)
+            return await self._generate(holistic_view, on_event)
+
+        response = await generate()
+
+        turn = self.max_turns
         while response and response["replies"][0].meta["finish_reason"] == "tool_calls" and turn != 0:
-            print(f"TURN {turn}")
-            print(response["replies"][0])
+            logger.debug("turn %d requested tools: %s", self.max_turns - turn + 1, response["replies"][0].content)
             func_calls = json.loads(response["replies"][0].content)
-            for func_call in func_calls:
-                func_name = func_call["function"]["name"]
-                func_args = json.loads(func_call["function"]["arguments"])
-                if func_name[:5] == "async":
-                    func_response = await self.tool_mapping[func_name](**func_args)
-                else:
-                    func_response = self.tool_mapping[func_name](**func_args)
-
-                print(func_response)
-                holistic_view.append(ChatMessage.from_function(
-                    content=json.dumps(func_response), name=func_name))
-                response = self.llm.run(messages=holistic_view, generation_kwargs={
-                    "tools": self.tool_schema})
+            results = await asyncio.gather(*(self._call_tool(func_call, on_event) for func_call in func_calls))
+            holistic_view.extend(results)
+            response = await generate()
             turn -= 1
-                
-        
 
+        LLM_TURNS.observe(self.max_turns - turn + 1)
+        CONTEXT_TOKENS.labels(type="sent").inc(sent)
+        CONTEXT_TOKENS.labels(type="saved").inc(saved)
+        logger.info("sent about %d prompt tokens in %d turns, context compaction saved %d",
+                    sent, self.max_turns - turn + 1, saved)
         return response["replies"][0] if response else ChatMessage.from_assistant("Failed to generate answer")
 
-    async def plan_workout_from_questionnaire(self, user_id: str, questionnaire: Questionnaire) -> str:
+    async def _plan_structured(self, user_id: str, questionnaire: Questionnaire,
+                               on_event: Optional[EventCallback] = None,
+                               run_id: Optional[str] = None) -> Tuple[str, Workout]:
+        """Retrieves exercises for the questionnaire up front, then asks for the whole workout in one completion"""
+        if self.retrieve is None or self.workouts is None:
+            raise StructuredOutputError("structured planning needs a retriever and a workout repository")
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(self.executor, partial(
+            contextvars.copy_context().run, self.retrieve, questionnaire_queries(questionnaire)))
+        if on_event:
+            on_event("exercises_retrieved", groups)
+
+        messages = [self.instructions, ChatMessage.from_user(
+            f"Create a personalized workout plan based on this questionnaire: {questionnaire.model_dump(mode='json')}\n"
+            f"Use only these exercises from the exercise database, grouped by the search that found them: "
+            f"{compact_json(compact_exercise_groups(groups))}")]
+        for attempt in range(self.max_repairs + 1):
+            reply = (await self._generate(messages, on_event, {"response_format": self.response_format}))["replies"][0]
+            try:
+                workout = parse_workout(reply.content, user_id)
+                break
+            except StructuredOutputError as err:
+                logger.info("structured workout failed validation on attempt %d: %s", attempt + 1, err)
+                if attempt == self.max_repairs:
+                    LLM_TURNS.observe(attempt + 1)
+                    raise
+                messages += [ChatMessage.from_assistant(reply.content or ""), ChatMessage.from_user(
+                    f"That workout is invalid: {err}. Reply with the corrected workout.")]
+        LLM_TURNS.observe(attempt + 1)
+
+        workout_id = await self.workouts.add(workout, run_id)
+        if on_event:
+            on_event("workout_persisted", {"id": workout_id})
+        return workout_id, workout
+
+    @timed(STAGE_SECONDS, stage="plan")
+    async def plan_workout_from_questionnaire(self, user_id: str, questionnaire: Questionnaire,
+                                              on_event: Optional[EventCallback] = None,
+                                              mode: Optional[PlanningMode] = None,
+                                              run_id: Optional[str] = None) -> str:
+        mode = mode or self.planning_mode
+        if self.plan_cache:
+            workout_id = await self.plan_cache.materialize(user_id, questionnaire, mode, run_id)
+            if workout_id:
+                if on_event:
+                    on_event("workout_persisted", {"id": workout_id})
+                return workout_id
+
+        if mode == PlanningMode.STRUCTURED:
+            workout_id, workout = await self._plan_structured(user_id, questionnaire, on_event, run_id)
+            if self.plan_cache:
+                await self.plan_cache.put(questionnaire, mode, workout)
+            return workout_id
+
         message = f"""
-        Create a personalized workout plan for user {user_id} based on the provided questionnaire. Query the exercise database once to fetch matching exercises, design the workout plan, and add it to the workout database once.
+        Create a personalized workout plan for user {user_id} based on the provided questionnaire. Query the exercise database once, passing every search you need in that single call, to fetch matching exercises, design the workout plan, and add it to the workout database once.
         Once the workout is successfully created, exit immediately without making any further function calls.
         Questionnaire: {questionnaire.model_dump()}
         """
-       
-        response = await self.chat(message, [])
-        return response.content
-        
+
+        run = AgentRun(user_id, run_id)
+        token = current_run.set(run)
+        try:
+            response = await self.chat(message, [], on_event)
+        finally:
+            current_run.reset(token)
+
+        if not run.workouts:
+            # a failure, so idempotent retries and jobs do not take the model's prose for a workout id
+            raise WorkoutNotCreatedError(f"the agent finished without adding a workout: {response.content}")
+        workout_id, workout = run.workouts[-1]
+        if self.plan_cache:
+            await self.plan_cache.put(questionnaire, mode, workout)
+        return workout_id
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,105 @@
+import re
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from haystack.dataclasses import ChatMessage
+
+
+logger = logging.getLogger(__name__)
+
+# role and separator tokens OpenAI adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+EXERCISE_FIELDS = re.compile(
+    r"name: (?P<name>.*?), description: .*?, muscle groups: (?P<muscle_groups>.*?), "
+    r"difficulty: (?P<difficulty>.*?), equipments: (?P<equipments>.*?), instructions: ", re.DOTALL)
+
+
+def load_token_counter(encoding: str = "o200k_base") -> Callable[[str], int]:
+    """tiktoken's count when it and its encoding files are available, roughly four characters per token otherwise"""
+    try:
+        import tiktoken
+        encoder = tiktoken.get_encoding(encoding)
+    except Exception as err:
+        logger.info("counting tokens approximately, tiktoken encoding %s is unavailable: %s", encoding, err)
+        return lambda text: (len(text) + 3) // 4
+    return lambda text: len(encoder.encode(text, disallowed_special=()))
+
+
+def compact_json(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def compact_exercises(contents: List[str]) -> List[Dict[str, str]]:
+    """Reduces retrieved exercise documents to the fields the model plans with"""
+    exercises = []
+    for content in contents:
+        fields = EXERCISE_FIELDS.match(content)
+        exercises.append(fields.groupdict() if fields else {"name": content[:80]})
+    return exercises
+
+
+def compact_exercise_groups(groups: Dict[str, List[str]]) -> Dict[str, List[Dict[str, str]]]:
+    return {query: compact_exercises(contents) for query, contents in groups.items()}
+
+
+def minimize_schema(schema: Any, defs: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Drops titles and null defaults, collapses Optional unions and inlines $refs. Descriptions are kept,
+    they carry the units the model has to respect.
+    """
+    if isinstance(schema, list):
+        return [minimize_schema(item, defs) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if defs is None:
+        defs = schema.get("$defs", {})
+    if "$ref" in schema:
+        return minimize_schema(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+
+    minimized = {}
+    for key, value in schema.items():
+        if key in ("title", "$defs") or (key == "default" and value is None):
+            continue
+        if key == "anyOf":
+            options = [option for option in value if option.get("type") != "null"]
+            if len(options) == 1:
+                minimized.update(minimize_schema(options[0], defs))
+                continue
+        minimized[key] = minimize_schema(value, defs) if key != "properties" else {
+            name: minimize_schema(prop, defs) for name, prop in value.items()}
+    return minimized
+
+
+class ContextWindow:
+    """
+    Keeps what the agent resends every turn small: counts tokens per message, trims the conversation
+    memory to a budget and totals how many prompt tokens the compaction saved.
+    """
+
+    def __init__(self, memory_token_budget: int = 2000, count_tokens: Optional[Callable[[str], int]] = None):
+        self.memory_token_budget = memory_token_budget
+        self.count_tokens = count_tokens or load_token_counter()
+
+    def count(self, message: ChatMessage) -> int:
+        if "tokens" not in message.meta:
+            message.meta["tokens"] = self.count_tokens(message.content or "") + MESSAGE_OVERHEAD_TOKENS
+        return message.meta["tokens"]
+
+    def count_all(self, messages: List[ChatMessage]) -> int:
+        return sum(self.count(message) for message in messages)
+
+    def fit_memory(self, memory: List[ChatMessage]) -> List[ChatMessage]:
+        """Keeps the most recent messages that fit the budget, noting how many were left out"""
+        kept, used = [], 0
+        for message in reversed(memory):
+            used += self.count(message)
+            if used > self.memory_token_budget:
+                break
+            kept.append(message)
+        kept.reverse()
+        dropped = len(memory) - len(kept)
+        if dropped:
+            kept.insert(0, ChatMessage.from_system(f"{dropped} earlier messages of this conversation were omitted."))
+        return kept
@@ -0,0 +1,265 @@
+import queue
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from haystack import component
+from haystack.components.embedders import OpenAITextEmbedder
+
+from observability.metrics import EMBEDDING_CACHE
+
+
+logger = logging.getLogger(__name__)
+
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+CacheKey = Tuple[str, str]
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU backed by an optional SQLite file of float32 vectors.
+    Concurrent lookups of the same key share a single upstream call, whether they come from
+    pipeline threads or from the event loop. The lock only guards the LRU and the in-flight map;
+    the file is read outside it, off the event loop for async callers, and written by its own thread.
+    """
+
+    def __init__(self, max_size: int = 4096, path: Optional[str] = None):
+        self.max_size = max_size
+        self._entries: OrderedDict[CacheKey, array] = OrderedDict()
+        self._inflight: Dict[CacheKey, Future] = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        if path:
+            writer_db = sqlite3.connect(path, check_same_thread=False)
+            # readers keep going while the writer commits
+            writer_db.execute("PRAGMA journal_mode=WAL")
+            writer_db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            writer_db.commit()
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._writer = threading.Thread(target=self._write, args=(writer_db,), name="embedding-cache-writer",
+                                            daemon=True)
+            self._writer.start()
+
+    @staticmethod
+    def key(text: str, model: str) -> CacheKey:
+        return model, " ".join(unicodedata.normalize("NFKC", text).split())
+
+    @staticmethod
+    def _digest(key: CacheKey) -> str:
+        return hashlib.sha256("\0".join(key).encode()).hexdigest()
+
+    def _remember(self, key: CacheKey, vector: array):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: CacheKey) -> Tuple[Optional[array], Optional[Future]]:
+        """
+        Returns the cached vector or the in-flight future to wait on. Neither means the caller now owns
+        the key: it must check the file, embed on a miss, and settle the key either way.
+        """
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                EMBEDDING_CACHE.labels(result="hit").inc()
+                return vector, None
+            if key in self._inflight:
+                EMBEDDING_CACHE.labels(result="coalesced").inc()
+                return None, self._inflight[key]
+            self._inflight[key] = Future()
+            return None, None
+
+    def _load(self, keys: List[CacheKey]) -> Dict[CacheKey, List[float]]:
+        """The vectors the file holds for owned keys, counting each key as a file hit or a miss"""
+        stored = {}
+        if self._db is not None and keys:
+            digests = {self._digest(key): key for key in keys}
+            rows = []
+            try:
+                with self._db_lock:
+                    # within SQLite's limit on bound parameters
+                    for start in range(0, len(digests), 500):
+                        batch = list(digests)[start:start + 500]
+                        rows += self._db.execute(
+                            f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                            batch).fetchall()
+            except sqlite3.Error as err:
+                logger.warning("embedding cache file unreadable, embedding instead: %s", err)
+            for digest, vector in rows:
+                try:
+                    stored[digests[digest]] = array("f", vector).tolist()
+                except (TypeError, ValueError) as err:
+                    logger.warning("embedding cache row %s undecodable, embedding instead: %s", digest, err)
+        for key in keys:
+            EMBEDDING_CACHE.labels(result="file_hit" if key in stored else "miss").inc()
+        return stored
+
+    async def _aload(self, keys: List[CacheKey]) -> Dict[CacheKey, List[float]]:
+        if self._db is None:
+            return self._load(keys)
+        return await asyncio.to_thread(self._load, keys)
+
+    def _settle(self, key: CacheKey, embedding: Optional[List[float]], error: Optional[BaseException] = None,
+                persist: bool = True):
+        with self._lock:
+            future = self._inflight.pop(key)
+            if error is None:
+                vector = array("f", embedding)
+                self._remember(key, vector)
+        if error is None:
+            if persist and self._writer is not None:
+                self._writes.put((self._digest(key), vector.tobytes()))
+            future.set_result(embedding)
+        else:
+            future.set_exception(error)
+
+    def _write(self, db: sqlite3.Connection):
+        """Writer thread: inserts queued vectors, committing once per batch of whatever has queued up"""
+        while (row := self._writes.get()) is not None:
+            rows = [row]
+            while True:
+                try:
+                    row = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    self._writes.put(None)
+                    break
+                rows.append(row)
+            try:
+                db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", rows)
+                db.commit()
+            except sqlite3.Error as err:
+                logger.warning("failed to persist %d embeddings: %s", len(rows), err)
+        db.close()
+
+    def get(self, text: str, model: str, embed: Callable[[str], List[float]]) -> List[float]:
+        return self.get_many([text], model, lambda texts: [embed(texts[0])])[0]
+
+    async def aget(self, text: str, model: str, embed: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        async def embed_one(texts: List[str]) -> List[List[float]]:
+            return [await embed(texts[0])]
+        return (await self.aget_many([text], model, embed_one))[0]
+
+    def _claim(self, keys: List[CacheKey], embeddings: List[Optional[List[float]]]) -> Tuple[List[int], Dict[int, Future]]:
+        owned, pending = [], {}
+        for i, key in enumerate(keys):
+            vector, future = self._lookup(key)
+            if vector is not None:
+                embeddings[i] = vector.tolist()
+            elif future is not None:
+                pending[i] = future
+            else:
+                owned.append(i)
+        return owned, pending
+
+    def _fill(self, keys: List[CacheKey], embeddings: List[Optional[List[float]]], owned: List[int],
+              found: Dict[CacheKey, List[float]], settled: set, persist: bool):
+        """Settles the owned keys that were found and records them as settled"""
+        for i in owned:
+            if keys[i] in found:
+                self._settle(keys[i], found[keys[i]], persist=persist)
+                settled.add(i)
+                embeddings[i] = found[keys[i]]
+
+    def _abandon(self, keys: List[CacheKey], owned: List[int], settled: set, error: BaseException):
+        """Fails every owned key not settled yet, so that nobody waits on it forever"""
+        for i in owned:
+            if i not in settled:
+                self._settle(keys[i], None, error)
+
+    def get_many(self, texts: List[str], model: str,
+                 embed_many: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        keys = [self.key(text, model) for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        owned, pending = self._claim(keys, embeddings)
+        settled = set()
+        try:
+            self._fill(keys, embeddings, owned, self._load([keys[i] for i in owned]), settled, persist=False)
+            missing = [i for i in owned if i not in settled]
+            if missing:
+                fresh = embed_many([texts[i] for i in missing])
+                self._fill(keys, embeddings, missing, dict(zip([keys[i] for i in missing], fresh)), settled,
+                           persist=True)
+                if len(fresh) != len(missing):
+                    raise ValueError(f"expected {len(missing)} embeddings, got {len(fresh)}")
+        except BaseException as err:
+            self._abandon(keys, owned, settled, err)
+            raise
+        for i, future in pending.items():
+            embeddings[i] = future.result()
+        return embeddings
+
+    async def aget_many(self, texts: List[str], model: str,
+                        embed_many: Callable[[List[str]], Awaitable[List[List[float]]]]) -> List[List[float]]:
+        keys = [self.key(text, model) for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        owned, pending = self._claim(keys, embeddings)
+        settled = set()
+        try:
+            self._fill(keys, embeddings, owned, await self._aload([keys[i] for i in owned]), settled, persist=False)
+            missing = [i for i in owned if i not in settled]
+            if missing:
+                fresh = await embed_many([texts[i] for i in missing])
+                self._fill(keys, embeddings, missing, dict(zip([keys[i] for i in missing], fresh)), settled,
+                           persist=True)
+                if len(fresh) != len(missing):
+                    raise ValueError(f"expected {len(missing)} embeddings, got {len(fresh)}")
+        except BaseException as err:
+            self._abandon(keys, owned, settled, err)
+            raise
+        for i, future in pending.items():
+            embeddings[i] = await asyncio.wrap_future(future)
+        return embeddings
+
+    def close(self):
+        if self._writer is not None:
+            # the writer drains what is queued before it stops
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+
+
+def embed_many(embedder: OpenAITextEmbedder, texts: List[str]) -> List[List[float]]:
+    """Embeds several texts in one request with the embedder's client and settings"""
+    kwargs = {"dimensions": embedder.dimensions} if embedder.dimensions is not None else {}
+    response = embedder.client.embeddings.create(
+        model=embedder.model,
+        input=[(embedder.prefix + text + embedder.suffix).replace("\n", " ") for text in texts],
+        **kwargs)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+@component
+class CachedTextEmbedder:
+    """Drop-in replacement for OpenAITextEmbedder that looks embeddings up in an EmbeddingCache first."""
+
+    def __init__(self, cache: EmbeddingCache, embedder: Optional[OpenAITextEmbedder] = None):
+        self.cache = cache
+        self.embedder = embedder or OpenAITextEmbedder(model=EMBEDDING_MODEL)
+
+    @component.output_types(embedding=List[float], meta=Dict[str, Any])
+    def run(self, text: str):
+        embedding = self.cache.get(
+            text, self.embedder.model, lambda text: self.embedder.run(text)["embedding"])
+        return {"embedding": embedding, "meta": {"model": self.embedder.model}}
+
+    def run_many(self, texts: List[str]) -> List[List[float]]:
+        return self.cache.get_many(texts, self.embedder.model, lambda texts: embed_many(self.embedder, texts))
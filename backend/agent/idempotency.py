@@ -0,0 +1,84 @@
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Generic, Optional, Tuple, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class IdempotencyConflictError(ValueError):
+    pass
+
+
+def run_id_for(key: str) -> str:
+    """The run id of every request carrying this key, so retries on any worker upsert the same workout"""
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+@dataclass
+class Flight(Generic[T]):
+    fingerprint: str
+    task: asyncio.Future
+    ttl: float
+    expires_at: float = float("inf")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesces runs by idempotency key: concurrent requests with a key attach to the run in flight, and
+    requests after it succeeded get its result until the key expires. Failed runs are forgotten so a
+    retry starts over. A caller going away does not cancel a run others may be waiting on.
+    """
+
+    def __init__(self, ttl_seconds: float = 24 * 3600, max_size: int = 10000):
+        self.ttl = ttl_seconds
+        self.max_size = max_size
+        self._flights: OrderedDict[str, Flight[T]] = OrderedDict()
+
+    def _settled(self, key: str, flight: Flight[T], task: asyncio.Future):
+        if self._flights.get(key) is not flight:
+            return
+        if task.cancelled() or task.exception() is not None:
+            del self._flights[key]
+        else:
+            flight.expires_at = time.monotonic() + flight.ttl
+
+    def _evict(self, now: float):
+        # oldest first, expired runs and, over the limit, finished ones; stopping at the first run to keep
+        # bounds the work per request, entries expired behind it are dropped when looked up or reached
+        while self._flights:
+            key, flight = next(iter(self._flights.items()))
+            if flight.expires_at > now and (not flight.task.done() or len(self._flights) <= self.max_size):
+                break
+            del self._flights[key]
+
+    async def run(self, key: str, fingerprint: str, start: Callable[[str], Awaitable[T]],
+                  ttl_seconds: Optional[float] = None) -> Tuple[T, bool]:
+        """
+        Returns the result of the run for key, starting it with its run id unless one is in flight or
+        finished, and whether the result was shared. The fingerprint identifies the request body; reusing
+        a key for a different body raises IdempotencyConflictError.
+        """
+        now = time.monotonic()
+        flight = self._flights.get(key)
+        if flight is not None and flight.expires_at <= now:
+            del self._flights[key]
+            flight = None
+        replayed = flight is not None
+        if flight is None:
+            task = asyncio.ensure_future(start(run_id_for(key)))
+            flight = Flight(fingerprint, task, self.ttl if ttl_seconds is None else ttl_seconds)
+            self._flights[key] = flight
+            task.add_done_callback(lambda done, key=key, flight=flight: self._settled(key, flight, done))
+            self._evict(now)
+        elif flight.fingerprint != fingerprint:
+            raise IdempotencyConflictError("Idempotency-Key was already used for a different request")
+        else:
+            logger.info("attaching to the run of an earlier request with the same idempotency key")
+        return await asyncio.shield(flight.task), replayed
@@ -0,0 +1,83 @@
+import math
+import time
+import uuid
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from schema.model import Questionnaire, WorkoutJob
+from schema.param import PlanningMode
+from storage.jobs import JobStore
+from agent.assisant import WorkoutAssistantAgent
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Workout generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WorkoutJobQueue:
+    """
+    Runs workout generation in the background on a fixed number of workers fed by a bounded queue,
+    so a burst of requests cannot fan out into an unbounded number of concurrent agent loops.
+    """
+
+    def __init__(self, agent: WorkoutAssistantAgent, store: JobStore, concurrency: int = 4, max_queue_size: int = 100):
+        self.agent = agent
+        self.store = store
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue[Tuple[WorkoutJob, Questionnaire, Optional[PlanningMode]]] = asyncio.Queue(max_queue_size)
+        self.workers: List[asyncio.Task] = []
+        self._average_duration = 15.0
+
+    def retry_after(self) -> int:
+        waves = (self.queue.qsize() + 1) / self.concurrency
+        return max(1, math.ceil(waves * self._average_duration))
+
+    async def submit(self, user_id: str, questionnaire: Questionnaire,
+                     mode: Optional[PlanningMode] = None) -> WorkoutJob:
+        if self.queue.full():
+            raise QueueFullError(self.retry_after())
+        job = WorkoutJob(id=uuid.uuid4().hex, user_id=user_id)
+        await self.store.create(job)
+        try:
+            self.queue.put_nowait((job, questionnaire, mode))
+        except asyncio.QueueFull:
+            await self.store.update(job.id, status=WorkoutJob.Status.FAILED, error="queue is full")
+            raise QueueFullError(self.retry_after())
+        return job
+
+    async def _run(self, job: WorkoutJob, questionnaire: Questionnaire, mode: Optional[PlanningMode]):
+        await self.store.update(job.id, status=WorkoutJob.Status.RUNNING)
+        started = time.monotonic()
+        try:
+            workout_id = await self.agent.plan_workout_from_questionnaire(
+                job.user_id, questionnaire, mode=mode, run_id=job.id)
+        except Exception as err:
+            await self.store.update(job.id, status=WorkoutJob.Status.FAILED, error=str(err))
+            return
+        self._average_duration = 0.8 * self._average_duration + 0.2 * (time.monotonic() - started)
+        await self.store.update(job.id, status=WorkoutJob.Status.SUCCEEDED, workout_id=workout_id)
+
+    async def _work(self):
+        while True:
+            job, questionnaire, mode = await self.queue.get()
+            try:
+                await self._run(job, questionnaire, mode)
+            except Exception:
+                logger.exception("workout job %s failed to record its state", job.id)
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
@@ -1,25 +1,54 @@
-from haystack import Pipeline
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+from haystack import Document, Pipeline
+from openai import OpenAI
+from pymongo import MongoClient
 from haystack_integrations.document_stores.mongodb_atlas import MongoDBAtlasDocumentStore
 from haystack.components.builders import PromptBuilder
 from haystack.components.embedders import OpenAITextEmbedder
 from haystack_integrations.components.retrievers.mongodb_atlas import MongoDBAtlasEmbeddingRetriever
 from haystack_integrations.document_stores.mongodb_atlas import MongoDBAtlasDocumentStore
 
+from agent.embedding_cache import EMBEDDING_MODEL, EmbeddingCache, CachedTextEmbedder, embed_many
+from agent.vector_index import NumpyEmbeddingRetriever
+from observability.metrics import PIPELINE_COMPONENT_SECONDS, STAGE_SECONDS, timed
+
+
+class SharedClientDocumentStore(MongoDBAtlasDocumentStore):
+    """MongoDBAtlasDocumentStore that reuses an existing client instead of opening its own pool"""
+
+    def __init__(self, client: MongoClient, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._connection = client
+
 
 class MongoDBRetrievalPipeline(Pipeline):
     mongodb_store: MongoDBAtlasDocumentStore
-    text_embedder: OpenAITextEmbedder
-    embedding_retriever: MongoDBAtlasEmbeddingRetriever
+    text_embedder: Union[OpenAITextEmbedder, CachedTextEmbedder]
+    embedding_retriever: Union[MongoDBAtlasEmbeddingRetriever, NumpyEmbeddingRetriever]
     prompt_builder: PromptBuilder
+    search_executor: ThreadPoolExecutor
 
-    def __init__(self, store: MongoDBAtlasDocumentStore) -> None:
+    def __init__(self,
+                 store: Optional[MongoDBAtlasDocumentStore] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 retriever: Optional[NumpyEmbeddingRetriever] = None,
+                 max_concurrent_searches: int = 4,
+                 openai_client: Optional[OpenAI] = None) -> None:
         super().__init__()
         self.mongodb_store = store
         self.text_embedder = OpenAITextEmbedder(
-            model="text-embedding-3-small",
+            model=EMBEDDING_MODEL,
         )
-        self.embedding_retriever = MongoDBAtlasEmbeddingRetriever(
+        if openai_client:
+            self.text_embedder.client = openai_client
+        if embedding_cache:
+            self.text_embedder = CachedTextEmbedder(embedding_cache, self.text_embedder)
+        self.embedding_retriever = retriever or MongoDBAtlasEmbeddingRetriever(
             document_store=self.mongodb_store, top_k=4)
+        self.search_executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_searches, thread_name_prefix="retrieval")
         self._build_pipeline()
 
     def _build_pipeline(self) -> None:
@@ -28,6 +57,7 @@ class MongoDBRetrievalPipeline(Pipeline):
                            name="embedding_retriever")
         self.connect("text_embedder.embedding", "embedding_retriever.query_embedding")
 
+    @timed(STAGE_SECONDS, stage="retrieval")
     def query(self, query: str) -> list[dict]:
         docs = self.run(
             {
@@ -35,3 +65,43 @@ class MongoDBRetrievalPipeline(Pipeline):
             }
         )["embedding_retriever"]["documents"]
         return [doc.content for doc in docs]
+
+    def _embed_many(self, texts: List[str]) -> List[List[float]]:
+        if isinstance(self.text_embedder, CachedTextEmbedder):
+            return self.text_embedder.run_many(texts)
+        return embed_many(self.text_embedder, texts)
+
+    def _search_many(self, embeddings: List[List[float]], top_k: Optional[int]) -> List[List[Document]]:
+        if isinstance(self.embedding_retriever, NumpyEmbeddingRetriever):
+            return self.embedding_retriever.run_batch(embeddings, top_k)
+        return list(self.search_executor.map(
+            lambda embedding: self.embedding_retriever.run(query_embedding=embedding, top_k=top_k)["documents"],
+            embeddings))
+
+    @timed(STAGE_SECONDS, stage="retrieval")
+    def query_many(self, queries: List[str], top_k: Optional[int] = None) -> Dict[str, List[str]]:
+        """
+        Embeds all queries in one request and runs their searches concurrently. An exercise matched by
+        several queries is only returned for the one it scored highest on.
+        """
+        queries = list(dict.fromkeys(query.strip() for query in queries if query.strip()))
+        if not queries:
+            return {}
+        with PIPELINE_COMPONENT_SECONDS.labels(component="text_embedder").time():
+            embeddings = self._embed_many(queries)
+        with PIPELINE_COMPONENT_SECONDS.labels(component="embedding_retriever").time():
+            groups = self._search_many(embeddings, top_k)
+
+        best: Dict[str, Tuple[float, int]] = {}
+        for position, documents in enumerate(groups):
+            for doc in documents:
+                score = doc.score if doc.score is not None else float("-inf")
+                if doc.id not in best or score > best[doc.id][0]:
+                    best[doc.id] = (score, position)
+        return {
+            query: [doc.content for doc in documents if best[doc.id][1] == position]
+            for position, (query, documents) in enumerate(zip(queries, groups))
+        }
+
+    def close(self):
+        self.search_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,111 @@
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+from schema.model import Questionnaire, Workout
+from schema.param import PlanningMode
+from storage.repository import WorkoutRepository, WorkoutPlanRepository
+
+
+logger = logging.getLogger(__name__)
+
+
+def questionnaire_fingerprint(questionnaire: Questionnaire) -> str:
+    canonical = json.dumps(questionnaire.model_dump(mode="json", exclude={"user_id"}),
+                           sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class PlanCache:
+    """
+    Workout templates generated for a questionnaire in a planning mode, shared by every user who submits the
+    same one. An in-process LRU sits in front of the persistent plans collection; both honour the same TTL.
+    Lookups are counted in memory and flushed to the collection in the background.
+    """
+
+    def __init__(self,
+                 plans: WorkoutPlanRepository,
+                 workouts: WorkoutRepository,
+                 ttl_seconds: float = 7 * 24 * 3600,
+                 max_size: int = 1024,
+                 flush_interval: float = 10.0,
+                 record_requests: bool = True):
+        self.plans = plans
+        self.workouts = workouts
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.record_requests = record_requests
+        self._entries: OrderedDict[str, Tuple[Workout, datetime]] = OrderedDict()
+        self._requests: Dict[str, Tuple[Questionnaire, int]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key(questionnaire: Questionnaire, mode: PlanningMode) -> str:
+        # plans of one mode never stand in for the other, so the modes stay comparable
+        return f"{questionnaire_fingerprint(questionnaire)}:{mode.value}"
+
+    def _fresh(self, created_at: datetime) -> bool:
+        return datetime.now(timezone.utc) - created_at < self.ttl
+
+    def _remember(self, key: str, workout: Workout, created_at: datetime):
+        self._entries[key] = (workout, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, questionnaire: Questionnaire, mode: PlanningMode) -> Optional[Workout]:
+        key = self.key(questionnaire, mode)
+        if self.record_requests:
+            # every lookup is counted so the warm-up knows which profiles are common
+            _, count = self._requests.get(key, (questionnaire, 0))
+            self._requests[key] = (questionnaire, count + 1)
+        entry = self._entries.get(key)
+        if entry is None or not self._fresh(entry[1]):
+            entry = await self.plans.get(key)
+        if entry and self._fresh(entry[1]):
+            self._remember(key, *entry)
+            return entry[0]
+        self._entries.pop(key, None)
+        return None
+
+    async def put(self, questionnaire: Questionnaire, mode: PlanningMode, workout: Workout):
+        template = workout.model_copy(update={"id": "", "user_id": None})
+        key = self.key(questionnaire, mode)
+        await self.plans.put(key, questionnaire, template)
+        self._remember(key, template, datetime.now(timezone.utc))
+
+    async def materialize(self, user_id: str, questionnaire: Questionnaire, mode: PlanningMode,
+                          run_id: Optional[str] = None) -> Optional[str]:
+        """Stores a copy of the cached plan for the user, returns its id or None on a miss"""
+        template = await self.get(questionnaire, mode)
+        if template is None:
+            return None
+        return await self.workouts.add(template.model_copy(update={"user_id": user_id}), run_id)
+
+    async def flush(self):
+        requests, self._requests = self._requests, {}
+        if requests:
+            await self.plans.record_requests(requests)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("failed to record plan requests")
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
@@ -0,0 +1,348 @@
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import logging
+import concurrent.futures
+from enum import IntEnum
+from typing import Iterator, AsyncIterator, List, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from observability.metrics import (OPENAI_CONCURRENCY_LIMIT, OPENAI_IN_FLIGHT, OPENAI_QUEUE_DEPTH, OPENAI_RETRIES,
+                                   OPENAI_WAIT_SECONDS)
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in an OpenAI reset header such as "1s", "6m0s" or "20ms" """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+
+def retry_after(headers: httpx.Headers) -> Optional[float]:
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def estimate_tokens(request: httpx.Request) -> int:
+    # roughly four bytes of JSON per token, the rate limit headers correct the estimate as responses arrive
+    return max(1, len(request.content) // 4)
+
+
+class TokenBucket:
+    """A per-minute budget refilled continuously, its capacity and level corrected from response headers"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, limit: Optional[str], remaining: Optional[str], now: float):
+        try:
+            if limit:
+                self.capacity = float(limit)
+            if remaining:
+                self._refill(now)
+                self.level = min(self.level, float(remaining))
+        except ValueError:
+            pass
+
+
+class OpenAIRateLimiter:
+    """
+    Admission control shared by every OpenAI client of the process. Requests wait in a priority queue,
+    interactive ahead of bulk, until a concurrency slot and the request and token budgets allow them.
+    The concurrency limit grows additively on success and halves on a 429, and the budgets follow the
+    x-ratelimit-* headers. Lives on the event loop; threads reach it through run_coroutine_threadsafe.
+    """
+
+    def __init__(self,
+                 requests_per_minute: int = 500,
+                 tokens_per_minute: int = 200000,
+                 max_concurrency: int = 32,
+                 min_concurrency: int = 1,
+                 max_retries: int = 5,
+                 base_delay: float = 0.5,
+                 max_delay: float = 30.0,
+                 acquire_timeout: float = 300.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # how long a worker thread waits for admission, so it cannot hang on a loop that stopped
+        self.acquire_timeout = acquire_timeout
+        self.in_flight = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        OPENAI_CONCURRENCY_LIMIT.set(self.concurrency)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    def backoff(self, attempt: int, hint: Optional[float] = None) -> float:
+        """The server's retry hint when given, otherwise full-jitter exponential backoff"""
+        if hint is not None:
+            return min(hint, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def acquire(self, priority: Priority, tokens: int):
+        loop = asyncio.get_running_loop()
+        self.loop = self.loop or loop
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), tokens, future))
+        OPENAI_QUEUE_DEPTH.labels(lane=priority.name.lower()).inc()
+        started = time.perf_counter()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # granted just as the waiter went away
+                self.release()
+            raise
+        finally:
+            OPENAI_WAIT_SECONDS.labels(lane=priority.name.lower()).observe(time.perf_counter() - started)
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while self._waiters:
+            priority, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                OPENAI_QUEUE_DEPTH.labels(lane=priority.name.lower()).dec()
+                continue
+            if self.in_flight >= int(self.concurrency):
+                return
+            delay = max(self._paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if delay > 0:
+                self._timer = self.loop.call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            OPENAI_QUEUE_DEPTH.labels(lane=priority.name.lower()).dec()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            OPENAI_IN_FLIGHT.set(self.in_flight)
+            future.set_result(None)
+
+    def observe(self, status: Optional[int], headers: Optional[httpx.Headers]):
+        """Adapts the concurrency limit and budgets to a response, or to a failed connection when status is None"""
+        now = time.monotonic()
+        if headers is not None:
+            self.requests.sync(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"), now)
+            self.tokens.sync(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"), now)
+        if status == 429:
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            pause = retry_after(headers) if headers is not None else None
+            if pause is None and headers is not None:
+                resets = [parse_duration(headers.get(name)) for name in
+                          ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+                pause = max((reset for reset in resets if reset is not None), default=None)
+            self._paused_until = max(self._paused_until, now + min(pause or self.base_delay, self.max_delay))
+        elif status is not None and status < 500:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        OPENAI_CONCURRENCY_LIMIT.set(self.concurrency)
+
+    def release(self):
+        self.in_flight -= 1
+        OPENAI_IN_FLIGHT.set(self.in_flight)
+        self._dispatch()
+
+    def should_retry(self, response: httpx.Response, attempt: int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        should = response.headers.get("x-should-retry")
+        if should in ("true", "false"):
+            return should == "true"
+        return response.status_code in RETRY_STATUSES
+
+
+class _ReleasingAsyncStream(httpx.AsyncByteStream):
+    """Holds the request's concurrency slot until the response body is closed, streamed or not"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, limiter: OpenAIRateLimiter):
+        self.stream = stream
+        self.limiter = limiter
+        self.released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.limiter.release()
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, limiter: OpenAIRateLimiter, priority: Priority,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.limiter = limiter
+        self.priority = priority
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_tokens(request)
+        for attempt in itertools.count():
+            await self.limiter.acquire(self.priority, tokens)
+            handed_over = False
+            try:
+                try:
+                    response = await self.transport.handle_async_request(request)
+                except httpx.TransportError as err:
+                    self.limiter.observe(None, None)
+                    if attempt >= self.limiter.max_retries:
+                        raise
+                    reason, hint = type(err).__name__, None
+                else:
+                    self.limiter.observe(response.status_code, response.headers)
+                    if not self.limiter.should_retry(response, attempt):
+                        response.stream = _ReleasingAsyncStream(response.stream, self.limiter)
+                        handed_over = True
+                        return response
+                    await response.aclose()
+                    reason, hint = str(response.status_code), retry_after(response.headers)
+            finally:
+                # cancellation or any other error must not leak the slot, only the response stream keeps it
+                if not handed_over:
+                    self.limiter.release()
+            delay = self.limiter.backoff(attempt, hint)
+            OPENAI_RETRIES.labels(lane=self.priority.name.lower(), reason=reason).inc()
+            logger.info("retrying %s %s in %.2fs after %s", request.method, request.url.path, delay, reason)
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class _ReleasingSyncStream(httpx.SyncByteStream):
+    def __init__(self, stream: httpx.SyncByteStream, release):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class SyncRateLimitedTransport(httpx.BaseTransport):
+    """The same admission and retries for the blocking clients haystack components use from worker threads"""
+
+    def __init__(self, limiter: OpenAIRateLimiter, priority: Priority, transport: Optional[httpx.BaseTransport] = None):
+        self.limiter = limiter
+        self.priority = priority
+        self.transport = transport or httpx.HTTPTransport()
+
+    def _on_loop(self, callback, *args):
+        self.limiter.loop.call_soon_threadsafe(callback, *args)
+
+    def _acquire(self, loop: asyncio.AbstractEventLoop, tokens: int):
+        admitted = asyncio.run_coroutine_threadsafe(self.limiter.acquire(self.priority, tokens), loop)
+        try:
+            admitted.result(timeout=self.limiter.acquire_timeout)
+        except concurrent.futures.TimeoutError:
+            # cancelling the waiter on the loop gives back a slot granted in the meantime
+            admitted.cancel()
+            raise httpx.PoolTimeout(f"not admitted by the OpenAI rate limiter within {self.limiter.acquire_timeout}s")
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        loop = self.limiter.loop
+        if loop is None:
+            raise RuntimeError("the OpenAI rate limiter has not been started")
+        tokens = estimate_tokens(request)
+        for attempt in itertools.count():
+            self._acquire(loop, tokens)
+            handed_over = False
+            try:
+                try:
+                    response = self.transport.handle_request(request)
+                except httpx.TransportError as err:
+                    self._on_loop(self.limiter.observe, None, None)
+                    if attempt >= self.limiter.max_retries:
+                        raise
+                    reason, hint = type(err).__name__, None
+                else:
+                    self._on_loop(self.limiter.observe, response.status_code, response.headers)
+                    if not self.limiter.should_retry(response, attempt):
+                        response.stream = _ReleasingSyncStream(response.stream, lambda: self._on_loop(self.limiter.release))
+                        handed_over = True
+                        return response
+                    response.close()
+                    reason, hint = str(response.status_code), retry_after(response.headers)
+            finally:
+                if not handed_over:
+                    self._on_loop(self.limiter.release)
+            delay = self.limiter.backoff(attempt, hint)
+            OPENAI_RETRIES.labels(lane=self.priority.name.lower(), reason=reason).inc()
+            logger.info("retrying %s %s in %.2fs after %s", request.method, request.url.path, delay, reason)
+            time.sleep(delay)
+
+    def close(self):
+        self.transport.close()
+
+
+def openai_client(limiter: OpenAIRateLimiter, priority: Priority) -> OpenAI:
+    """A blocking OpenAI client admitted through the limiter, which owns retries"""
+    return OpenAI(http_client=httpx.Client(transport=SyncRateLimitedTransport(limiter, priority)), max_retries=0)
+
+
+def async_openai_client(limiter: OpenAIRateLimiter, priority: Priority) -> AsyncOpenAI:
+    return AsyncOpenAI(http_client=httpx.AsyncClient(transport=RateLimitedTransport(limiter, priority)), max_retries=0)
@@ -0,0 +1,92 @@
+import json
+from typing import Any, Dict, List, Optional
+
+from pydantic import ValidationError
+
+from schema.model import Questionnaire, Workout
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+GOAL_QUERIES = {
+    Questionnaire.FitnessGoal.WEIGHT_LOSS: "fat burning cardio and full body conditioning exercises",
+    Questionnaire.FitnessGoal.MUSCLE_GAIN: "compound strength exercises for muscle hypertrophy",
+    Questionnaire.FitnessGoal.STAYING_FIT: "balanced full body exercises for general fitness",
+    Questionnaire.FitnessGoal.ENDURANCE: "endurance and aerobic conditioning exercises",
+}
+
+
+def questionnaire_queries(questionnaire: Questionnaire) -> List[str]:
+    """The searches the agent would typically make for a questionnaire, derived without asking the model"""
+    level = questionnaire.experience_level.value
+    queries = [f"{level} {GOAL_QUERIES[questionnaire.fitness_goal]}"]
+    if not questionnaire.has_equipment:
+        queries.append(f"{level} bodyweight exercises without equipment")
+    elif questionnaire.workout_location == Questionnaire.WorkoutLocation.GYM:
+        queries.append(f"{level} gym exercises with free weights and machines")
+    else:
+        queries.append(f"{level} exercises with dumbbells, kettlebells or resistance bands")
+    if questionnaire.workout_location == Questionnaire.WorkoutLocation.OUTDOORS:
+        queries.append("outdoor running, sprinting and bodyweight exercises")
+    elif questionnaire.space_constraint <= 3:
+        queries.append("exercises that need very little space")
+    queries.append(f"{level} core and mobility exercises")
+    return queries
+
+
+def strict_json_schema(schema: Any, defs: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Rewrites a pydantic JSON schema for OpenAI's strict structured outputs: $refs inlined, every property
+    required, no additional properties, and Optional fields expressed as nullable types.
+    """
+    if isinstance(schema, list):
+        return [strict_json_schema(item, defs) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if defs is None:
+        defs = schema.get("$defs", {})
+    if "$ref" in schema:
+        return strict_json_schema(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        if len(options) == 1 and len(options) < len(schema["anyOf"]):
+            nullable = strict_json_schema(options[0], defs)
+            nullable["type"] = [nullable["type"], "null"]
+            if "description" in schema:
+                nullable["description"] = schema["description"]
+            return nullable
+
+    strict = {key: strict_json_schema(value, defs) for key, value in schema.items()
+              if key not in ("title", "default", "$defs", "properties")}
+    if "properties" in schema:
+        strict["properties"] = {name: strict_json_schema(prop, defs) for name, prop in schema["properties"].items()}
+        strict["required"] = list(schema["properties"])
+        strict["additionalProperties"] = False
+    return strict
+
+
+def workout_response_format() -> Dict[str, Any]:
+    schema = Workout.model_json_schema()
+    # the user id is filled in by the server, not chosen by the model
+    schema["properties"].pop("user_id", None)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "workout", "strict": True, "schema": strict_json_schema(schema)},
+    }
+
+
+def parse_workout(content: Optional[str], user_id: str) -> Workout:
+    """Validates the model's JSON as a Workout, raising StructuredOutputError with the reasons on failure"""
+    try:
+        workout_dict = json.loads(content or "")
+    except ValueError as err:
+        raise StructuredOutputError(f"the reply is not valid JSON: {err}")
+    if not isinstance(workout_dict, dict):
+        raise StructuredOutputError("the reply must be a JSON object")
+    try:
+        return Workout.model_validate({**workout_dict, "user_id": user_id})
+    except ValidationError as err:
+        raise StructuredOutputError("; ".join(
+            f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in err.errors()))
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from haystack import Document, component
+
+from storage.repository import ExerciseRepository
+
+
+EMBEDDING_DIM = 1536
+
+Match = Tuple[str, str, float]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class ExerciseVectorIndex:
+    """
+    Exercise embeddings held in one contiguous, pre-normalised float32 matrix for brute-force cosine search.
+    Writers are serialised and publish a new (matrix, ids, contents) view, so searches never take a lock.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._buffer = np.empty((0, dim), dtype=np.float32)
+        self._publish(0, [], [])
+
+    def __len__(self) -> int:
+        return len(self._view[1])
+
+    def _publish(self, size: int, ids: List[str], contents: List[str]):
+        self._view = (self._buffer[:size], tuple(ids), tuple(contents))
+        self._positions = {exercise_id: i for i, exercise_id in enumerate(ids)}
+
+    def _reset(self, ids: List[str], contents: List[str], matrix: np.ndarray):
+        with self._lock:
+            self._buffer = matrix
+            self._publish(len(ids), ids, contents)
+
+    async def load(self, repository: ExerciseRepository):
+        ids, contents, rows = [], [], []
+        async for exercise_id, content, embedding in repository.iter_embeddings():
+            ids.append(exercise_id)
+            contents.append(content)
+            rows.append(embedding)
+        matrix = np.asarray(rows, dtype=np.float32).reshape(len(rows), self.dim)
+        self._reset(ids, contents, _normalize(matrix))
+
+    def digest(self) -> str:
+        """The digest ExerciseRepository.embeddings_digest gives while Mongo holds exactly these exercises"""
+        _, ids, contents = self._view
+        digest = hashlib.sha256()
+        for exercise_id, content in sorted(zip(ids, contents)):
+            digest.update(f"{exercise_id}\0{hashlib.sha256(content.encode()).hexdigest()}\n".encode())
+        return digest.hexdigest()
+
+    def load_snapshot(self, path: str, digest: Optional[str] = None) -> bool:
+        """Loads the snapshot unless it is missing or, given the collection's digest, out of date"""
+        matrix_path, meta_path = Path(f"{path}.npy"), Path(f"{path}.json")
+        if not matrix_path.exists() or not meta_path.exists():
+            return False
+        meta = json.loads(meta_path.read_text())
+        if digest is not None and meta.get("digest") != digest:
+            return False
+        self._reset(meta["ids"], meta["contents"], np.load(matrix_path, mmap_mode="r"))
+        return True
+
+    def save_snapshot(self, path: str):
+        matrix, ids, contents = self._view
+        # write aside and rename, the current snapshot may still be memory-mapped
+        with open(f"{path}.npy.tmp", "wb") as file:
+            np.save(file, matrix)
+        Path(f"{path}.json.tmp").write_text(json.dumps({"ids": ids, "contents": contents, "digest": self.digest()}))
+        os.replace(f"{path}.npy.tmp", f"{path}.npy")
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    def upsert(self, exercise_id: str, content: str, embedding: Sequence[float]):
+        row = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            matrix, ids, contents = self._view
+            ids, contents = list(ids), list(contents)
+            position = self._positions.get(exercise_id)
+            if position is not None:
+                # copy so in-flight searches keep reading the old row
+                self._buffer = np.array(matrix)
+                contents[position] = content
+            else:
+                position = len(ids)
+                if position == len(self._buffer) or not self._buffer.flags.writeable:
+                    grown = np.empty((max(2 * position, 64), self.dim), dtype=np.float32)
+                    grown[:position] = matrix
+                    self._buffer = grown
+                ids.append(exercise_id)
+                contents.append(content)
+            self._buffer[position] = row
+            self._publish(len(ids), ids, contents)
+
+    def remove(self, exercise_id: str) -> bool:
+        with self._lock:
+            position = self._positions.get(exercise_id)
+            if position is None:
+                return False
+            matrix, ids, contents = self._view
+            self._buffer = np.delete(matrix, position, axis=0)
+            self._publish(len(ids) - 1, [*ids[:position], *ids[position + 1:]],
+                          [*contents[:position], *contents[position + 1:]])
+            return True
+
+    def search(self, query: Sequence[float], top_k: int = 4) -> List[Match]:
+        return self.search_batch([query], top_k)[0]
+
+    def search_batch(self, queries: Sequence[Sequence[float]], top_k: int = 4) -> List[List[Match]]:
+        matrix, ids, contents = self._view
+        k = min(top_k, len(ids))
+        if k == 0:
+            return [[] for _ in queries]
+        scores = _normalize(np.asarray(queries, dtype=np.float32)) @ matrix.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        return [[(ids[i], contents[i], float(score)) for i, score in zip(row, row_scores)]
+                for row, row_scores in zip(top.tolist(), top_scores.tolist())]
+
+
+@component
+class NumpyEmbeddingRetriever:
+    """Local stand-in for MongoDBAtlasEmbeddingRetriever backed by an ExerciseVectorIndex."""
+
+    def __init__(self, index: ExerciseVectorIndex, top_k: int = 4):
+        self.index = index
+        self.top_k = top_k
+
+    @component.output_types(documents=List[Document])
+    def run(self, query_embedding: List[float], filters: Optional[Dict[str, Any]] = None, top_k: Optional[int] = None):
+        matches = self.index.search(query_embedding, top_k or self.top_k)
+        return {"documents": [Document(id=exercise_id, content=content, score=score)
+                              for exercise_id, content, score in matches]}
+
+    def run_batch(self, query_embeddings: List[List[float]], top_k: Optional[int] = None) -> List[List[Document]]:
+        return [[Document(id=exercise_id, content=content, score=score) for exercise_id, content, score in matches]
+                for matches in self.index.search_batch(query_embeddings, top_k or self.top_k)]
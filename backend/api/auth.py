@@ -1,9 +1,19 @@
-from typing import Optional
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
 
 import jwt
+import httpx
 from fastapi import HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials
 
+from observability.metrics import STAGE_SECONDS, timed
+
 class UnauthorizedException(HTTPException):
     def __init__(self, detail: str, **kwargs):
         """Returns HTTP 403"""
@@ -17,22 +27,109 @@ class UnauthenticatedException(HTTPException):
 
 
 class TokenVerifier:
-    def __init__(self, auth0_domain: str, auth0_api_audience: str, auth0_issuer: str, auth0_algo: str):
-        jwks_url = f'https://{auth0_domain}/.well-known/jwks.json'
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+    """
+    Verifies Auth0 bearer tokens without blocking the event loop. The JWKS is fetched asynchronously and
+    served stale while a background refresh runs; tokens that already passed verification are remembered
+    by hash until they expire.
+    """
+
+    def __init__(self,
+                 auth0_domain: str,
+                 auth0_api_audience: str,
+                 auth0_issuer: str,
+                 auth0_algo: str,
+                 jwks_url: Optional[str] = None,
+                 jwks_ttl: float = 600,
+                 jwks_min_refresh_interval: float = 30,
+                 token_cache_size: int = 10000):
+        self.jwks_url = jwks_url or f'https://{auth0_domain}/.well-known/jwks.json'
         self.auth0_api_audience = auth0_api_audience
         self.auth0_issuer = auth0_issuer
         self.auth0_algo = auth0_algo
+        self.jwks_ttl = jwks_ttl
+        self.jwks_min_refresh_interval = jwks_min_refresh_interval
+        self.token_cache_size = token_cache_size
+        self.http_client = httpx.AsyncClient(timeout=10)
+        self._signing_keys: Dict[str, Any] = {}
+        self._jwks_fetched_at = float("-inf")
+        self._refresh: Optional[asyncio.Task] = None
+        self._verified: OrderedDict[bytes, Tuple[str, float]] = OrderedDict()
+
+    async def start(self):
+        try:
+            await self._schedule_refresh()
+        except (httpx.HTTPError, jwt.exceptions.PyJWKSetError, OSError, ValueError):
+            # verify() retries the fetch on demand
+            pass
+
+    async def close(self):
+        await self.http_client.aclose()
+
+    async def _fetch_jwks(self) -> Dict[str, Any]:
+        url = urlparse(self.jwks_url)
+        if url.scheme == "file":
+            return json.loads(await asyncio.to_thread(Path(url.path).read_text))
+        response = await self.http_client.get(self.jwks_url)
+        response.raise_for_status()
+        return response.json()
+
+    async def _refresh_keys(self):
+        jwks = jwt.PyJWKSet.from_dict(await self._fetch_jwks())
+        self._signing_keys = {jwk.key_id: jwk.key for jwk in jwks.keys}
+        self._jwks_fetched_at = time.monotonic()
+
+    def _schedule_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._refresh_keys())
+            # failures of background refreshes are retried on the next request
+            self._refresh.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return self._refresh
 
+    async def _signing_key(self, kid: Optional[str]) -> Any:
+        age = time.monotonic() - self._jwks_fetched_at
+        signing_key = self._signing_keys.get(kid)
+        if signing_key is not None:
+            if age > self.jwks_ttl:
+                self._schedule_refresh()
+            return signing_key
+
+        # unknown kid, the keys may have been rotated
+        if age > self.jwks_min_refresh_interval:
+            try:
+                await self._schedule_refresh()
+            except (httpx.HTTPError, jwt.exceptions.PyJWKSetError, OSError, ValueError) as err:
+                raise UnauthorizedException(f"Failed to fetch JWKS: {err}")
+            signing_key = self._signing_keys.get(kid)
+        if signing_key is None:
+            raise UnauthorizedException(f'Unable to find a signing key that matches: "{kid}"')
+        return signing_key
+
+    def _remember(self, digest: bytes, sub: str, expires_at: float):
+        self._verified[digest] = (sub, expires_at)
+        self._verified.move_to_end(digest)
+        while len(self._verified) > self.token_cache_size:
+            self._verified.popitem(last=False)
+
+    @timed(STAGE_SECONDS, stage="auth")
     async def verify(self, token: Optional[HTTPAuthorizationCredentials]) -> str:
         if not token:
             raise UnauthenticatedException
-    
+
+        digest = hashlib.sha256(token.credentials.encode()).digest()
+        cached = self._verified.get(digest)
+        if cached:
+            sub, expires_at = cached
+            if expires_at > time.time():
+                self._verified.move_to_end(digest)
+                return sub
+            self._verified.pop(digest, None)
+
         try:
-            signing_key = self.jwks_client.get_signing_key_from_jwt(token.credentials).key
-        except (jwt.exceptions.PyJWKClientError, jwt.exceptions.DecodeError) as err:
+            kid = jwt.get_unverified_header(token.credentials).get("kid")
+        except jwt.exceptions.DecodeError as err:
             raise UnauthorizedException(str(err))
-        
+        signing_key = await self._signing_key(kid)
+
         try:
             payload = jwt.decode(
                 token.credentials,
@@ -43,7 +140,7 @@ class TokenVerifier:
             )
         except jwt.exceptions.PyJWTError as err:
             raise UnauthorizedException(str(err))
-            
-        return payload['sub']
-        
 
+        if "exp" in payload:
+            self._remember(digest, payload["sub"], payload["exp"])
+        return payload['sub']
@@ -1,14 +1,63 @@
-from typing import Optional
+import json
+import math
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from openai import AsyncOpenAI, OpenAIError
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, InternalServerError, OpenAIError, RateLimitError
+from pydantic import ValidationError
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from api.http_response import HTTPResponse
+from api.http_response import HTTPResponse, RawHTTPResponse, SSEvent, dump_json
 from api.auth import TokenVerifier
 from schema.model import Questionnaire, Exercise
+from schema.param import PlanningMode
 from storage.repository import WorkoutRepository, ExerciseRepository
-from agent.assisant import WorkoutAssistantAgent
+from storage.workout_cache import CachedWorkoutRepository
+from storage.vectors import pack_float32, unpack_float32
+from agent.assisant import WorkoutAssistantAgent, WorkoutNotCreatedError
+from agent.structured import StructuredOutputError
+from agent.embedding_cache import EMBEDDING_MODEL, EmbeddingCache
+from agent.vector_index import ExerciseVectorIndex
+from agent.jobs import QueueFullError, WorkoutJobQueue
+from agent.idempotency import IdempotencyConflictError, SingleFlight
+from agent.plan_cache import questionnaire_fingerprint
+from agent.rate_limit import retry_after
+
+
+logger = logging.getLogger(__name__)
+
+
+def exercise_embed_text(exercise: Exercise) -> str:
+    return (f"name: {exercise.name}, description: {exercise.description}, "
+            f"muscle groups: {' '.join(exercise.muscle_groups)}, difficulty: {exercise.difficulty}, "
+            f"equipments: {' '.join(exercise.equipments)}, instructions: {exercise.instructions}, "
+            f"tags: {' '.join(exercise.tags)}")
+
+
+def content_hash(embed_text: str) -> str:
+    return hashlib.sha256(embed_text.encode()).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def openai_error_response(err: OpenAIError):
+    """A 503 for failures worth retrying later, passing on OpenAI's Retry-After, a 502 for rejected requests"""
+    if not isinstance(err, (RateLimitError, APIConnectionError, InternalServerError)):
+        return HTTPResponse(502, f"OpenAI rejected the request: {err}")
+    headers = None
+    if isinstance(err, APIStatusError) and (hint := retry_after(err.response.headers)) is not None:
+        headers = {"Retry-After": str(math.ceil(hint))}
+    return HTTPResponse(503, "OpenAI is unavailable, retry later", headers=headers)
 
 
 class WorkoutController:
@@ -16,33 +65,114 @@ class WorkoutController:
                  repository: WorkoutRepository,
                  assisant_agent: WorkoutAssistantAgent,
                  token_verifier: TokenVerifier,
+                 job_queue: Optional[WorkoutJobQueue] = None,
+                 idempotency: Optional[SingleFlight] = None,
+                 fallback_key_ttl: float = 600,
                  router: APIRouter = APIRouter()
                  ):
         self.router = router
         self.repository = repository
         self.assistant = assisant_agent
         self.token_verifier = token_verifier
+        self.job_queue = job_queue
+        self.idempotency = idempotency
+        self.fallback_key_ttl = fallback_key_ttl
         self.register_routes()
 
     def register_routes(self):
         self.router.post("/workouts")(self.create_workout)
+        self.router.post("/workouts/stream")(self.stream_workout)
+        if self.job_queue:
+            self.router.post("/workouts/jobs", status_code=202)(self.submit_workout_job)
+            self.router.get("/workouts/jobs/{job_id}")(self.get_workout_job)
         self.router.get("/workouts")(self.get_workout)
         self.router.delete("/workouts/{workout_id}")(self.remove_workout)
 
-    async def create_workout(self, questionnaire: Questionnaire, token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+    async def create_workout(self, questionnaire: Questionnaire, response: Response,
+                             mode: Optional[PlanningMode] = None,
+                             idempotency_key: Optional[str] = Header(None, max_length=255),
+                             token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
         user_id = await self.token_verifier.verify(token)
-        print(f"SET{user_id}")
-        workout_id = await self.assistant.plan_workout_from_questionnaire(user_id, questionnaire)
+        logger.info("planning a workout for %s", user_id)
+
+        def plan(run_id: Optional[str] = None):
+            return self.assistant.plan_workout_from_questionnaire(user_id, questionnaire, mode=mode, run_id=run_id)
+
+        try:
+            if not self.idempotency:
+                workout_id = await plan()
+            else:
+                # without a key, retries are recognised by the questionnaire for a shorter while
+                # the mode is part of the request, reusing a key with another one is a conflict
+                fingerprint = f"{questionnaire_fingerprint(questionnaire)}:{(mode or self.assistant.planning_mode).value}"
+                key = f"{user_id}:key:{idempotency_key}" if idempotency_key else f"{user_id}:questionnaire:{fingerprint}"
+                workout_id, replayed = await self.idempotency.run(
+                    key, fingerprint, plan, None if idempotency_key else self.fallback_key_ttl)
+                if replayed:
+                    response.headers["Idempotent-Replayed"] = "true"
+        except IdempotencyConflictError as err:
+            return HTTPResponse(422, str(err))
+        except StructuredOutputError as err:
+            return HTTPResponse(502, f"Failed to generate a valid workout: {err}")
+        except WorkoutNotCreatedError as err:
+            return HTTPResponse(502, f"Failed to generate a workout: {err}")
         return HTTPResponse(201,  {"id": workout_id})
 
-    async def get_workout(self, token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+    async def stream_workout(self, questionnaire: Questionnaire, mode: Optional[PlanningMode] = None,
+                             token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+        user_id = await self.token_verifier.verify(token)
+        events = asyncio.Queue()
+        events.put_nowait(("authenticated", {"user_id": user_id}))
+        plan = asyncio.create_task(self.assistant.plan_workout_from_questionnaire(
+            user_id, questionnaire, on_event=lambda event, data: events.put_nowait((event, data)), mode=mode))
+        plan.add_done_callback(lambda _: events.put_nowait(None))
+
+        async def stream():
+            while (item := await events.get()) is not None:
+                yield SSEvent(*item)
+            if plan.cancelled() or plan.exception():
+                if plan.cancelled():
+                    logger.warning("streamed workout plan for %s was cancelled", user_id)
+                else:
+                    logger.error("failed to generate a streamed workout for %s", user_id, exc_info=plan.exception())
+                yield SSEvent("error", {"detail": "Failed to generate workout"})
+                return
+            yield SSEvent("done", HTTPResponse(201, {"id": plan.result()}))
+
+        return StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def submit_workout_job(self, questionnaire: Questionnaire, mode: Optional[PlanningMode] = None,
+                                 token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+        user_id = await self.token_verifier.verify(token)
+        try:
+            job = await self.job_queue.submit(user_id, questionnaire, mode)
+        except QueueFullError as err:
+            return HTTPResponse(429, str(err), headers={"Retry-After": str(err.retry_after)})
+        return HTTPResponse(202, {"id": job.id, "status": job.status})
+
+    async def get_workout_job(self, job_id: str, token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+        user_id = await self.token_verifier.verify(token)
+        job = await self.job_queue.store.get(job_id)
+        if not job or job.user_id != user_id:
+            return HTTPResponse(404)
+        return HTTPResponse(200, job.model_dump(mode="json", exclude={"user_id"}))
+
+    async def get_workout(self, token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer()),
+                          if_none_match: Optional[str] = Header(None)):
         user_id = await self.token_verifier.verify(token)
-        print(f"GET{user_id}")
-        workout = await self.repository.get(user_id)
-        print(workout)
+        if isinstance(self.repository, CachedWorkoutRepository):
+            cached = await self.repository.get_cached(user_id)
+            if not cached.document:
+                return HTTPResponse(404)
+            headers = {"ETag": f'"{cached.content_hash}"', "Cache-Control": "private, no-cache"}
+            if etag_matches(if_none_match, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+            return RawHTTPResponse(200, cached.document, headers=headers)
+        workout = await self.repository.get_document(user_id)
         if not workout:
             return HTTPResponse(404)
-        return HTTPResponse(200, workout.model_dump())
+        return RawHTTPResponse(200, workout)
 
     async def remove_workout(self, workout_id: str):
         removed = await self.repository.remove(workout_id)
@@ -55,47 +185,193 @@ class ExerciseController:
     def __init__(self,
                  repository: ExerciseRepository,
                  openai_client: AsyncOpenAI,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 vector_index: Optional[ExerciseVectorIndex] = None,
+                 embedding_batch_size: int = 256,
                  router: APIRouter = APIRouter()
                  ):
         self.router = router
         self.repository = repository
         self.openai_client = openai_client
+        self.embedding_cache = embedding_cache
+        self.vector_index = vector_index
+        self.embedding_batch_size = embedding_batch_size
         self.register_routes()
 
     def register_routes(self):
         self.router.post("/exercises")(self.create_exercise)
+        self.router.post("/exercises/bulk")(self.bulk_create_exercises)
         self.router.get("/exercises")(self.list_all_exercises)
         self.router.get("/exercises/{exercise_id}")(self.get_exercise)
         self.router.delete("/exercises/{exercise_id}")(self.remove_exercise)
 
+    async def _embed(self, text: str) -> List[float]:
+        if self.embedding_cache:
+            return await self.embedding_cache.aget(text, EMBEDDING_MODEL, self._embed_uncached)
+        return await self._embed_uncached(text)
+
+    async def _embed_uncached(self, text: str) -> List[float]:
+        embedding = await self.openai_client.embeddings.create(
+            input=text,
+            model=EMBEDDING_MODEL
+        )
+        return embedding.data[0].embedding
+
+    async def _embed_many(self, texts: List[str]) -> List[List[float]]:
+        if self.embedding_cache:
+            return await self.embedding_cache.aget_many(texts, EMBEDDING_MODEL, self._embed_many_uncached)
+        return await self._embed_many_uncached(texts)
+
+    async def _embed_many_uncached(self, texts: List[str]) -> List[List[float]]:
+        embeddings = await self.openai_client.embeddings.create(
+            input=texts,
+            model=EMBEDDING_MODEL
+        )
+        return [item.embedding for item in sorted(embeddings.data, key=lambda item: item.index)]
+
     async def create_exercise(self, exercise: Exercise):
-        embed_text = f"name: {exercise.name}, description: {exercise.description}, muscle groups: {' '.join(exercise.muscle_groups)}, difficulty: {exercise.difficulty}, equipments: {
-            ' '.join(exercise.equipments)}, instructions: {exercise.instructions}, tags: {' '.join(exercise.tags)}"
+        embed_text = exercise_embed_text(exercise)
         try:
-            embedding = await self.openai_client.embeddings.create(
-                input=embed_text,
-                model="text-embedding-3-small"
-            )
-        except OpenAIError:
-            return HTTPResponse(503)
+            embedding = await self._embed(embed_text)
+        except OpenAIError as err:
+            return openai_error_response(err)
 
         exercise.content = embed_text
-        exercise.embedding = embedding.data[0].embedding
+        exercise.content_hash = content_hash(embed_text)
+        exercise.embedding = pack_float32(embedding)
         exercise_id = await self.repository.add(exercise)
+        if self.vector_index is not None:
+            self.vector_index.upsert(exercise_id, exercise.content, embedding)
         return HTTPResponse(201, {"id": exercise_id})
 
+    async def bulk_create_exercises(self, request: Request):
+        results = []
+        batch = []
+        async for item in self._read_bulk_items(request):
+            results.append({"index": len(results)})
+            try:
+                batch.append((results[-1], Exercise.model_validate(item)))
+            except ValidationError as err:
+                results[-1].update({"status": "invalid", "error": str(err)})
+            if len(batch) == self.embedding_batch_size:
+                await self._ingest_batch(batch)
+                batch = []
+        if batch:
+            await self._ingest_batch(batch)
+        return HTTPResponse(201, results)
+
+    async def _read_bulk_items(self, request: Request) -> AsyncIterator[Any]:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            buffer = b""
+            async for chunk in request.stream():
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield self._parse_ndjson_line(line)
+            if buffer.strip():
+                yield self._parse_ndjson_line(buffer)
+            return
+        try:
+            items = await request.json()
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise HTTPException(422, "Expected a JSON array or NDJSON stream of exercises")
+        for item in items:
+            yield item
+
+    @staticmethod
+    def _parse_ndjson_line(line: bytes) -> Any:
+        try:
+            return json.loads(line)
+        except ValueError:
+            # left to fail validation so the item gets an "invalid" result
+            return line.decode(errors="replace")
+
+    async def _ingest_batch(self, batch: List[Tuple[Dict, Exercise]]):
+        # one write per name, an unordered bulk write would race upserts of the same _id; the last item wins
+        latest = {exercise.name: result for result, exercise in batch}
+        for result, exercise in batch:
+            if latest[exercise.name] is not result:
+                result.update({"id": exercise.name, "status": "superseded",
+                               "superseded_by": latest[exercise.name]["index"]})
+        batch = [(result, exercise) for result, exercise in batch if latest[exercise.name] is result]
+        stored_hashes = await self.repository.content_hashes([exercise.name for _, exercise in batch])
+        changed = []
+        for result, exercise in batch:
+            exercise.content = exercise_embed_text(exercise)
+            exercise.content_hash = content_hash(exercise.content)
+            result["id"] = exercise.name
+            if stored_hashes.get(exercise.name) == exercise.content_hash:
+                result["status"] = "unchanged"
+            else:
+                changed.append((result, exercise))
+        if not changed:
+            return
+
+        try:
+            embeddings = await self._embed_many([exercise.content for _, exercise in changed])
+        except OpenAIError as err:
+            for result, _ in changed:
+                result.update({"status": "failed", "error": str(err)})
+            return
+        for (_, exercise), embedding in zip(changed, embeddings):
+            exercise.embedding = pack_float32(embedding)
+
+        errors = await self.repository.add_many([exercise for _, exercise in changed])
+        for position, (result, exercise) in enumerate(changed):
+            if position in errors:
+                result.update({"status": "failed", "error": errors[position]})
+                continue
+            result["status"] = "updated" if exercise.name in stored_hashes else "created"
+            if self.vector_index is not None:
+                self.vector_index.upsert(exercise.name, exercise.content, unpack_float32(exercise.embedding))
+
     async def get_exercise(self, exercise_id: str):
-        exercise = await self.repository.get(exercise_id)
+        exercise = await self.repository.get_document(exercise_id)
         if not exercise:
             return HTTPResponse(404)
-        return HTTPResponse(200, exercise.model_dump(exclude={"embedding"}))
+        return RawHTTPResponse(200, exercise)
+
+    async def list_all_exercises(self,
+                                 request: Request,
+                                 limit: int = Query(100, ge=1, le=1000),
+                                 cursor: Optional[str] = None,
+                                 muscle_group: Optional[str] = None,
+                                 difficulty: Optional[str] = None,
+                                 equipment: Optional[str] = None,
+                                 stream: bool = False):
+        try:
+            if stream or "application/x-ndjson" in request.headers.get("accept", ""):
+                documents = self.repository.stream(cursor, muscle_group, difficulty, equipment)
+                return StreamingResponse(self._ndjson(documents), media_type="application/x-ndjson")
+            exercises, next_cursor = await self.repository.list_page_documents(
+                limit, cursor, muscle_group, difficulty, equipment)
+        except ValueError as err:
+            return HTTPResponse(400, str(err))
+        return RawHTTPResponse(200, exercises, {"next_cursor": next_cursor})
 
-    async def list_all_exercises(self):
-        exercises = await self.repository.list_all()
-        return HTTPResponse(200, [exercise.model_dump(exclude={"embedding"}) for exercise in exercises])
+    @staticmethod
+    async def _ndjson(documents: AsyncIterator[Dict]) -> AsyncIterator[bytes]:
+        async for document in documents:
+            yield dump_json(document) + b"\n"
 
     async def remove_exercise(self, exercise_id: str):
         removed = await self.repository.remove(exercise_id)
         if not removed:
             return HTTPResponse(404)
+        if self.vector_index is not None:
+            self.vector_index.remove(exercise_id)
         return HTTPResponse(204)
+
+
+class MetricsController:
+    def __init__(self, router: APIRouter = APIRouter()):
+        self.router = router
+        self.register_routes()
+
+    def register_routes(self):
+        self.router.get("/metrics", include_in_schema=False)(self.metrics)
+
+    async def metrics(self):
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,25 @@
+from typing import Optional
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+
+class HealthController:
+    """Liveness as soon as the app serves, readiness once the warm-up after startup has finished"""
+
+    def __init__(self, router: Optional[APIRouter] = None):
+        self.router = router or APIRouter()
+        self.is_ready = False
+        self.register_routes()
+
+    def register_routes(self):
+        self.router.get("/health/live", include_in_schema=False)(self.live)
+        self.router.get("/health/ready", include_in_schema=False)(self.ready)
+
+    async def live(self):
+        return {"status": "live"}
+
+    async def ready(self):
+        if not self.is_ready:
+            return JSONResponse({"status": "warming up"}, status_code=503)
+        return {"status": "ready"}
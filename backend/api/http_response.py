@@ -1,12 +1,34 @@
-from typing import Any
+import json
+from typing import Any, Dict, Optional
 
+import orjson
 from fastapi import HTTPException
+from fastapi.responses import Response
 
 
-def HTTPResponse(status_code: int, message: str = "", data: Any = None):
+def HTTPResponse(status_code: int, message: str = "", data: Any = None, headers: Optional[Dict[str, str]] = None):
     if status_code >= 400:
-        raise HTTPException(status_code=status_code, detail=message)
+        raise HTTPException(status_code=status_code, detail=message, headers=headers)
     response = {"message": message}
     if data:
         response.update({"body": data})
     return response
+
+
+def dump_json(content: Any) -> bytes:
+    # str for the stray ObjectId or Decimal a raw document may carry
+    return orjson.dumps(content, default=str)
+
+
+def RawHTTPResponse(status_code: int, message: Any = "", data: Any = None,
+                    headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    The HTTPResponse envelope serialized once with orjson into a raw response, skipping FastAPI's
+    jsonable_encoder. Only for plain, trusted data such as documents read with a projection.
+    """
+    return Response(dump_json(HTTPResponse(status_code, message, data, headers)), status_code=status_code,
+                    media_type="application/json", headers=headers)
+
+
+def SSEvent(event: str, data: Any = None) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,253 @@
+"""
+Offline load test of the backend. OpenAI, the Auth0 JWKS and (by default) Mongo are replaced by
+local stand-ins so runs cost nothing and are comparable between commits. The in-memory Mongo needs
+mongomock-motor, which is not part of the app's requirements.
+
+    python -m benchmark --concurrency 16 --requests 200 --output results.json
+    python -m benchmark --baseline results.json
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+import httpx
+from fastapi import FastAPI
+
+from benchmark.fake_openai import FakeOpenAI
+from benchmark.issuer import LocalIssuer
+from benchmark.harness import (InMemoryStorage, LoopLagMonitor, ServerThread, configure_environment,
+                               summarize_ms)
+from storage.mongo import MongoStorage
+
+
+SCENARIOS = ["list_exercises", "get_exercise", "create_workout", "retry_workout", "get_workout", "poll_workout"]
+
+# requests per idempotency key in retry_workout, like a client retrying a slow create
+RETRIES_PER_KEY = 4
+
+MUSCLE_GROUPS = ["chest", "back", "legs", "shoulders", "arms", "core", "full body"]
+
+
+def synthetic_exercises(count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    return [{
+        "name": f"Exercise {index:05d}",
+        "description": f"Synthetic exercise number {index}",
+        "muscle_groups": rng.sample(MUSCLE_GROUPS, 2),
+        "difficulty": rng.choice(["beginner", "intermediate", "advanced"]),
+        "equipments": rng.sample(["dumbbell", "barbell", "kettlebell", "mat", "none"], 1),
+        "instructions": "Keep a neutral spine and control the movement.",
+        "video_url": "",
+        "tags": rng.sample(["strength", "cardio", "mobility", "hiit"], 2),
+    } for index in range(count)]
+
+
+def synthetic_questionnaire(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "frequency": rng.choice(["daily", "weekly", "biweekly", "occasionally"]),
+        "fitness_goal": rng.choice(["weight loss", "muscle gain", "staying fit", "endurance"]),
+        "workout_location": rng.choice(["home", "gym", "outdoors"]),
+        "space_constraint": rng.randint(0, 10),
+        "has_equipment": rng.random() < 0.5,
+        "experience_level": rng.choice(["beginner", "intermediate", "advanced"]),
+        "workout_duration": rng.choice([20, 30, 45, 60]),
+    }
+
+
+async def drive(client: httpx.AsyncClient, requests: int, concurrency: int,
+                send: Callable[[int], Any]) -> Dict[str, Any]:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for index in remaining:
+            started = time.perf_counter()
+            try:
+                response = await send(index)
+                status = str(response.status_code)
+                errors += response.status_code >= 400
+            except httpx.HTTPError as err:
+                status = type(err).__name__
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "errors": errors,
+        "status_codes": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(requests / elapsed, 2),
+        "latency_ms": summarize_ms(latencies),
+    }
+
+
+async def agent_runs(client: httpx.AsyncClient, base_url: str) -> float:
+    """Agent runs the server has counted, one per plan it actually generated with the LLM"""
+    response = await client.get(f"{base_url}/metrics")
+    response.raise_for_status()
+    for line in response.text.splitlines():
+        if line.startswith("agent_llm_turns_count "):
+            return float(line.split()[1])
+    return 0.0
+
+
+async def run_scenarios(args: argparse.Namespace, base_url: str, issuer: LocalIssuer, fake_openai: FakeOpenAI,
+                        monitor: LoopLagMonitor) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    users = [f"benchmark|{index}" for index in range(args.users)]
+    headers = {user: {"Authorization": f"Bearer {issuer.token(user)}"} for user in users}
+    exercises = synthetic_exercises(args.exercises, rng)
+    results: Dict[str, Any] = {}
+    planning_mode = {"mode": args.planning_mode} if args.planning_mode else None
+    retried_questionnaires = [synthetic_questionnaire(rng) for _ in range(args.requests // RETRIES_PER_KEY + 1)]
+    run_key = uuid.uuid4().hex
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"{base_url}/api", limits=limits, timeout=args.timeout) as client:
+        started = time.perf_counter()
+        response = await client.post("/exercises/bulk", json=exercises)
+        response.raise_for_status()
+        results["seed"] = {"exercises": len(exercises), "elapsed_s": round(time.perf_counter() - started, 3)}
+
+        etags: Dict[str, str] = {}
+
+        async def poll_workout(index: int) -> httpx.Response:
+            """Revalidates the user's workout like the frontend's polling, with the last ETag seen"""
+            user = users[index % len(users)]
+            conditional = {"If-None-Match": etags[user]} if user in etags else {}
+            response = await client.get("/workouts", headers={**headers[user], **conditional})
+            if "etag" in response.headers:
+                etags[user] = response.headers["etag"]
+            return response
+
+        senders: Dict[str, Callable[[int], Any]] = {
+            "list_exercises": lambda index: client.get("/exercises", params={"limit": 50}),
+            "get_exercise": lambda index: client.get(f"/exercises/{exercises[index % len(exercises)]['name']}"),
+            "create_workout": lambda index: client.post(
+                "/workouts", json=synthetic_questionnaire(rng), params=planning_mode,
+                headers=headers[users[index % len(users)]]),
+            "retry_workout": lambda index: client.post(
+                "/workouts", json=retried_questionnaires[index // RETRIES_PER_KEY], params=planning_mode,
+                headers={**headers[users[index // RETRIES_PER_KEY % len(users)]],
+                         "Idempotency-Key": f"{run_key}-{index // RETRIES_PER_KEY}"}),
+            "get_workout": lambda index: client.get("/workouts", headers=headers[users[index % len(users)]]),
+            "poll_workout": poll_workout,
+        }
+        results["scenarios"] = {}
+        for scenario in args.scenarios:
+            before = fake_openai.stats.snapshot()
+            runs_before = await agent_runs(client, base_url)
+            monitor.collect()
+            result = await drive(client, args.requests, args.concurrency, senders[scenario])
+            result["loop_lag_ms"] = summarize_ms(monitor.collect())
+            after = fake_openai.stats.snapshot()
+            result["openai"] = {key: after[key] - before[key] for key in after}
+            if scenario in ("create_workout", "retry_workout"):
+                # coalesced retries and plan cache hits make no LLM call, only runs of the agent count
+                plans = round(await agent_runs(client, base_url) - runs_before)
+                result["plans_generated"] = plans
+                result["llm_turns_per_plan"] = round(result["openai"]["chat_completions"] / plans, 3) if plans else None
+            results["scenarios"][scenario] = result
+            print(f"{scenario}: {result['rps']} rps, p50 {result['latency_ms'].get('p50')} ms, "
+                  f"p99 {result['latency_ms'].get('p99')} ms, errors {result['errors']}")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]):
+    print(f"\n{'scenario':<16}{'metric':<10}{'baseline':>12}{'current':>12}{'change':>10}")
+    for scenario, result in current["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if not previous:
+            continue
+        metrics = [("rps", previous["rps"], result["rps"])]
+        metrics += [(p, previous["latency_ms"].get(p), result["latency_ms"].get(p)) for p in ("p50", "p95", "p99")]
+        for metric, before, after in metrics:
+            change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else "n/a"
+            print(f"{scenario:<16}{metric:<10}{str(before):>12}{str(after):>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the backend against local stand-ins")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS,
+                        help=f"comma separated, any of {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50, help="distinct token subjects")
+    parser.add_argument("--exercises", type=int, default=200, help="synthetic exercises seeded before the run")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per chat completion")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--openai-rpm", type=int,
+                        help="requests per minute the fake OpenAI allows before answering 429")
+    parser.add_argument("--mongo-uri", help="use this Mongo instead of the in-memory one")
+    parser.add_argument("--plan-cache", action="store_true", help="keep the plan cache enabled")
+    parser.add_argument("--planning-mode", choices=["agent", "structured"],
+                        help="plan workouts in this mode instead of the server's default")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    issuer = LocalIssuer()
+    fake_openai = FakeOpenAI(chat_latency=args.llm_latency, embedding_latency=args.embedding_latency,
+                             requests_per_minute=args.openai_rpm)
+    stand_in = FastAPI()
+    stand_in.include_router(fake_openai.router)
+    stand_in.include_router(issuer.router)
+    stand_in_server = ServerThread(stand_in)
+    stand_in_server.start()
+    configure_environment(stand_in_server.url, issuer.audience, issuer.issuer, args.mongo_uri, args.plan_cache)
+
+    import main as backend
+    app = backend.create_app(storage_cls=MongoStorage if args.mongo_uri else InMemoryStorage)
+    monitor = LoopLagMonitor()
+    app.add_event_handler("startup", monitor.start)
+    app.add_event_handler("shutdown", monitor.stop)
+    app_server = ServerThread(app)
+    app_server.start()
+
+    try:
+        results = asyncio.run(run_scenarios(args, app_server.url, issuer, fake_openai, monitor))
+    finally:
+        app_server.stop()
+        stand_in_server.stop()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        **results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
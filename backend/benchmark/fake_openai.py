@@ -0,0 +1,219 @@
+import re
+import json
+import time
+import uuid
+import base64
+import asyncio
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from agent.vector_index import EMBEDDING_DIM
+
+
+class RateLimited(Exception):
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = headers
+
+
+@dataclass
+class FakeOpenAIStats:
+    chat_completions: int = 0
+    embedding_requests: int = 0
+    embedding_inputs: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    rate_limited: int = 0
+
+    def snapshot(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+def fake_embedding(text: str) -> np.ndarray:
+    """Deterministic unit vector per text, so identical inputs retrieve identical neighbours"""
+    rng = np.random.default_rng(zlib.crc32(text.encode()))
+    vector = rng.standard_normal(EMBEDDING_DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+@dataclass
+class FakeOpenAI:
+    """
+    Serves the subset of the OpenAI API the backend uses. Chat completions follow the script of a
+    workout plan: search the exercises with several queries in one tool call, store a workout built
+    from what was retrieved, then answer in plain text. Requests with a response_format get the
+    workout JSON straight away, built from the exercises given in the prompt. With requests_per_minute,
+    requests beyond that rate get a 429 and every response carries the x-ratelimit headers.
+    """
+    chat_latency: float = 0.5
+    embedding_latency: float = 0.05
+    stream_chunk_delay: float = 0.005
+    requests_per_minute: Optional[int] = None
+    stats: FakeOpenAIStats = field(default_factory=FakeOpenAIStats)
+    _budget: float = field(default=0.0, init=False)
+    _budget_updated: float = field(default_factory=time.monotonic, init=False)
+
+    def __post_init__(self):
+        self._budget = float(self.requests_per_minute or 0)
+
+    def _admit(self) -> Dict[str, str]:
+        """Spends one request of the per-minute budget, returns the rate limit headers or raises the 429"""
+        if not self.requests_per_minute:
+            return {}
+        now = time.monotonic()
+        rate = self.requests_per_minute / 60
+        self._budget = min(self.requests_per_minute, self._budget + (now - self._budget_updated) * rate)
+        self._budget_updated = now
+        headers = {"x-ratelimit-limit-requests": str(self.requests_per_minute),
+                   "x-ratelimit-reset-requests": f"{(self.requests_per_minute - self._budget) / rate:.3f}s"}
+        if self._budget < 1:
+            self.stats.rate_limited += 1
+            retry_ms = int((1 - self._budget) / rate * 1000) + 1
+            raise RateLimited({**headers, "x-ratelimit-remaining-requests": "0", "retry-after-ms": str(retry_ms)})
+        self._budget -= 1
+        return {**headers, "x-ratelimit-remaining-requests": str(int(self._budget))}
+
+    @staticmethod
+    def _rate_limited(err: "RateLimited") -> JSONResponse:
+        return JSONResponse({"error": {"message": "Rate limit reached for requests", "type": "requests",
+                                       "code": "rate_limit_exceeded"}}, status_code=429, headers=err.headers)
+
+    @property
+    def router(self) -> APIRouter:
+        router = APIRouter()
+        router.post("/v1/chat/completions")(self.chat_completions)
+        router.post("/v1/embeddings")(self.embeddings)
+        return router
+
+    @staticmethod
+    def _workout(names: List[str]) -> Dict[str, Any]:
+        exercises = [{
+            "exercise_name": name,
+            "day": "Monday",
+            "duration": 60,
+            "repetitions": 12,
+            "sets": 3,
+            "rest_between_sets": 60,
+            "estimated_calories_burned": 10.0,
+            "notes": "",
+        } for name in dict.fromkeys(names or ["Push-up"])]
+        return {
+            "exercises": exercises,
+            "estimated_duration": 30,
+            "target_muscle_groups": ["full body"],
+            "total_calories_burned": int(sum(exercise["estimated_calories_burned"] for exercise in exercises)),
+        }
+
+    def _script(self, messages: List[Dict[str, Any]], structured: bool = False) -> Dict[str, Any]:
+        user_message = next((message["content"] for message in messages if message["role"] == "user"), "")
+        if structured:
+            return {"content": json.dumps(self._workout(re.findall(r'"name": ?"([^"]+)"', user_message)))}
+
+        results = {message.get("name"): message["content"] for message in messages if message["role"] in ("function", "tool")}
+        if "add_workout" in results:
+            return {"content": "Your workout plan has been created."}
+        if "query_exercises" not in results:
+            return {"tool_calls": [{"name": "query_exercises", "arguments": {"queries": [
+                "full body strength exercises", "cardio conditioning exercises", "core stability exercises"]}}]}
+
+        user_id = re.search(r"for user (\S+)", user_message)
+        names = re.findall(r'"name": ?"([^"]+)"', " ".join(results.values()))
+        return {"tool_calls": [{"name": "add_workout", "arguments": {
+            "user_id": user_id.group(1) if user_id else "", **self._workout(names)}}]}
+
+    @staticmethod
+    def _tool_calls(reply: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [{
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])},
+        } for call in reply["tool_calls"]]
+
+    def _chunks(self, completion_id: str, model: str, reply: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        if "tool_calls" in reply:
+            tool_calls = self._tool_calls(reply)
+            yield chunk({"role": "assistant", "tool_calls": [
+                {"index": index, "id": call["id"], "type": "function", "function": {"name": call["function"]["name"], "arguments": ""}}
+                for index, call in enumerate(tool_calls)]})
+            for index, call in enumerate(tool_calls):
+                arguments = call["function"]["arguments"]
+                for start in range(0, len(arguments), 64):
+                    yield chunk({"tool_calls": [{"index": index, "function": {"arguments": arguments[start:start + 64]}}]})
+            yield chunk({}, "tool_calls")
+        else:
+            yield chunk({"role": "assistant", "content": ""})
+            for word in reply["content"].split(" "):
+                yield chunk({"content": word + " "})
+            yield chunk({}, "stop")
+
+    async def chat_completions(self, request: Request):
+        try:
+            headers = self._admit()
+        except RateLimited as err:
+            return self._rate_limited(err)
+        body = await request.json()
+        reply = self._script(body["messages"], structured="response_format" in body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "gpt-4o-mini")
+        prompt_tokens = estimate_tokens(json.dumps(body["messages"]) + json.dumps(body.get("tools", []))
+                                        + json.dumps(body.get("response_format", {})))
+        completion_tokens = estimate_tokens(json.dumps(reply))
+        self.stats.chat_completions += 1
+        self.stats.prompt_tokens += prompt_tokens
+        self.stats.completion_tokens += completion_tokens
+        await asyncio.sleep(self.chat_latency)
+
+        if body.get("stream"):
+            async def stream():
+                for chunk in self._chunks(completion_id, model, reply):
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await asyncio.sleep(self.stream_chunk_delay)
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+        message: Dict[str, Any] = {"role": "assistant", "content": reply.get("content")}
+        if "tool_calls" in reply:
+            message["tool_calls"] = self._tool_calls(reply)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message,
+                         "finish_reason": "tool_calls" if "tool_calls" in reply else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }, headers=headers)
+
+    async def embeddings(self, request: Request):
+        try:
+            headers = self._admit()
+        except RateLimited as err:
+            return self._rate_limited(err)
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.stats.embedding_requests += 1
+        self.stats.embedding_inputs += len(inputs)
+        await asyncio.sleep(self.embedding_latency)
+
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_embedding(text)
+            embedding = base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(estimate_tokens(text) for text in inputs)
+        return JSONResponse({"object": "list", "data": data, "model": body.get("model"),
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}, headers=headers)
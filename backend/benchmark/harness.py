@@ -0,0 +1,107 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI
+
+from storage.mongo import MongoStorage
+
+
+class InMemoryStorage(MongoStorage):
+    """MongoStorage backed by mongomock, for benchmarks that should not need a running mongod"""
+
+    def __init__(self, mongo_uri: str, db_name: str, **kwargs):
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("the in-memory Mongo needs mongomock-motor, install it or pass --mongo-uri")
+        super().__init__(mongo_uri, db_name, **kwargs)
+        self.client = AsyncMongoMockClient()
+        self.db = self.client[db_name]
+
+
+class ServerThread:
+    """Runs an ASGI app with uvicorn on its own thread and event loop, bound to a free local port"""
+
+    def __init__(self, app: FastAPI):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.server = uvicorn.Server(uvicorn.Config(app, log_level="warning", access_log=False, timeout_graceful_shutdown=5))
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.socket.getsockname()
+        return f"http://{host}:{port}"
+
+    def start(self, timeout: float = 60):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"server on {self.url} failed to start")
+            time.sleep(0.01)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from a short sleep, a proxy for blocking work on it"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _sample(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def collect(self) -> List[float]:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+def summarize_ms(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3),
+            "mean": round(float(values.mean()), 3), "max": round(float(values.max()), 3)}
+
+
+def configure_environment(stand_in_url: str, audience: str, issuer: str, mongo_uri: Optional[str], plan_cache: bool):
+    """Points the app's settings at the local stand-ins, overriding anything from .env"""
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{stand_in_url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_KEY": "benchmark",
+        "AUTH0_DOMAIN": "benchmark.local",
+        "AUTH0_JWKS_URL": f"{stand_in_url}/.well-known/jwks.json",
+        "AUTH0_API_AUDIENCE": audience,
+        "AUTH0_ISSUER": issuer,
+        "AUTH0_ALGORITHMS": "RS256",
+        "MONGO_URI": mongo_uri or "mongodb://localhost:27017",
+        "PLAN_CACHE_ENABLED": str(plan_cache).lower(),
+    })
+    os.environ.setdefault("MONGO_DB_NAME", "benchmark")
+    # neither mongomock nor a local mongod implement Atlas $vectorSearch
+    os.environ.setdefault("EXERCISE_RETRIEVER", "numpy")
@@ -0,0 +1,32 @@
+import time
+from typing import Any, Dict
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import APIRouter
+
+
+class LocalIssuer:
+    """Signs RS256 access tokens and publishes the matching JWKS, standing in for the Auth0 tenant"""
+
+    def __init__(self, audience: str = "benchmark-api", issuer: str = "https://benchmark.local/", kid: str = "benchmark"):
+        self.audience = audience
+        self.issuer = issuer
+        self.kid = kid
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    @property
+    def jwks(self) -> Dict[str, Any]:
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key(), as_dict=True)
+        return {"keys": [{**jwk, "kid": self.kid, "alg": "RS256", "use": "sig"}]}
+
+    @property
+    def router(self) -> APIRouter:
+        router = APIRouter()
+        router.get("/.well-known/jwks.json")(lambda: self.jwks)
+        return router
+
+    def token(self, sub: str, ttl: int = 3600) -> str:
+        now = int(time.time())
+        claims = {"sub": sub, "aud": self.audience, "iss": self.issuer, "iat": now, "exp": now + ttl}
+        return jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.kid})
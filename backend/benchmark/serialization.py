@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of building read responses from documents as Mongo returns them. The validated path is
+what the controllers did before: a model per document, model_dump, the HTTPResponse envelope, FastAPI's
+jsonable_encoder and the stdlib json. The raw path serializes the projected documents once with orjson.
+No server or Mongo is involved, and both paths must produce the same JSON.
+
+    python -m benchmark.serialization --exercises 1000 --repeat 50
+"""
+import json
+import time
+import random
+import argparse
+from typing import Any, Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from api.http_response import HTTPResponse, RawHTTPResponse
+from benchmark.__main__ import synthetic_exercises
+from schema.model import Exercise, Workout
+from storage.repository import ExerciseRepository, encode_cursor
+
+
+def stored_exercises(count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    documents = []
+    for exercise_dict in synthetic_exercises(count, rng):
+        exercise = Exercise(**exercise_dict, embedding=[rng.random() for _ in range(1536)],
+                            content=f"name: {exercise_dict['name']}", content_hash="0" * 64)
+        documents.append(ExerciseRepository._document(exercise))
+    return documents
+
+
+def stored_workout(rng: random.Random) -> Dict[str, Any]:
+    return {
+        "_id": "6523f1c2a4b5c6d7e8f90123",
+        "user_id": "benchmark|0",
+        "exercises": [{
+            "exercise_name": f"Exercise {index:05d}", "day": f"day {index % 3 + 1}", "duration": None,
+            "repetitions": rng.randint(6, 15), "sets": rng.randint(2, 5), "rest_between_sets": 60,
+            "estimated_calories_burned": round(rng.uniform(3, 12), 1), "notes": "Keep a neutral spine",
+        } for index in range(15)],
+        "estimated_duration": 45,
+        "target_muscle_groups": ["legs", "core"],
+        "total_calories_burned": 350,
+    }
+
+
+def project(document: Dict[str, Any], excluded: Dict[str, int]) -> Dict[str, Any]:
+    return {key: value for key, value in document.items() if key not in excluded}
+
+
+def with_id(document: Dict[str, Any]) -> Dict[str, Any]:
+    document = dict(document)
+    document["id"] = str(document.pop("_id"))
+    return document
+
+
+def validated(content: Any) -> bytes:
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def time_per_call(build: Callable[[], bytes], repeat: int) -> float:
+    build()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        build()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the validated and the raw response path of read endpoints")
+    parser.add_argument("--exercises", type=int, default=1000, help="exercises in the listed page")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    exercises = stored_exercises(args.exercises, rng)
+    listed = [project(document, ExerciseRepository.list_projection) for document in exercises]
+    detail = project(exercises[0], ExerciseRepository.detail_projection)
+    workout = stored_workout(rng)
+    next_cursor = encode_cursor(exercises[-1]["_id"])
+    list_excluded = {"embedding", "content", "content_hash"}
+
+    cases = {
+        f"list {args.exercises} exercises": (
+            lambda: validated(HTTPResponse(200, [Exercise(**with_id(document)).model_dump(exclude=list_excluded)
+                                                 for document in listed], {"next_cursor": next_cursor})),
+            lambda: RawHTTPResponse(200, [with_id(document) for document in listed], {"next_cursor": next_cursor}).body,
+        ),
+        "get exercise": (
+            lambda: validated(HTTPResponse(200, Exercise(**with_id(exercises[0])).model_dump(
+                exclude={"embedding", "content_hash"}))),
+            lambda: RawHTTPResponse(200, with_id(detail)).body,
+        ),
+        "get workout": (
+            lambda: validated(HTTPResponse(200, Workout(**with_id(workout)).model_dump())),
+            lambda: RawHTTPResponse(200, with_id(workout)).body,
+        ),
+    }
+    print(f"{'case':<24}{'validated':>14}{'raw':>14}{'speedup':>10}")
+    for name, (validated_path, raw_path) in cases.items():
+        if json.loads(validated_path()) != json.loads(raw_path()):
+            raise SystemExit(f"{name}: the raw path produced different JSON")
+        before, after = time_per_call(validated_path, args.repeat), time_per_call(raw_path, args.repeat)
+        print(f"{name:<24}{before * 1e6:>11.1f} us{after * 1e6:>11.1f} us{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Cold start benchmark. Each run spawns a fresh interpreter serving the app against the local stand-ins
+and reports how long `import main` and `create_app` took in it, and how long after the spawn the first
+response, the first authenticated API response and readiness arrived.
+
+    python -m benchmark.startup --runs 5 --output startup.json
+"""
+import sys
+import json
+import time
+import argparse
+
+
+def serve(port: int, in_memory: bool):
+    """The child: times the app's import and construction, reports them on stdout, then serves"""
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    if in_memory:
+        from benchmark.harness import InMemoryStorage
+        storage_cls = InMemoryStorage
+    else:
+        storage_cls = main.MongoStorage
+    created = time.perf_counter()
+    app = main.create_app(storage_cls=storage_cls)
+    print(json.dumps({"import_s": round(imported - started, 3), "create_app_s": round(time.perf_counter() - created, 3)}),
+          flush=True)
+
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+def timings(lines) -> dict:
+    for line in lines:
+        if line.startswith('{"import_s"'):
+            return json.loads(line)
+    raise RuntimeError("the server did not report its import time")
+
+
+def measure(port: int, in_memory: bool, token: str, timeout: float) -> dict:
+    import os
+    import subprocess
+    import httpx
+
+    command = [sys.executable, "-m", "benchmark.startup", "--serve", str(port)]
+    if not in_memory:
+        command.append("--mongo")
+    spawned = time.perf_counter()
+    # the app logs to stdout too, quieter so the pipe never fills while nobody reads it
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, env={**os.environ, "LOG_LEVEL": "WARNING"})
+    result = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as client:
+            deadline = spawned + timeout
+            for name, path, headers in (("first_response_s", "/health/live", None),
+                                        ("first_request_s", "/api/workouts", {"Authorization": f"Bearer {token}"}),
+                                        ("ready_s", "/health/ready", None)):
+                while True:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"the server exited with {process.returncode} before {path} answered")
+                    if time.perf_counter() > deadline:
+                        raise RuntimeError(f"{path} did not answer within {timeout}s")
+                    try:
+                        # the benchmark user has no workout yet, a 404 is as good an answer as any
+                        if client.get(path, headers=headers).status_code in (200, 404):
+                            break
+                    except httpx.TransportError:
+                        pass
+                    time.sleep(0.005)
+                result[name] = round(time.perf_counter() - spawned, 3)
+        result.update(timings(process.stdout))
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the backend against local stand-ins")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mongo-uri", help="use this Mongo instead of the in-memory one")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--mongo", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, not args.mongo)
+        return
+
+    import socket
+    from fastapi import FastAPI
+    from benchmark.__main__ import git_commit
+    from benchmark.fake_openai import FakeOpenAI
+    from benchmark.issuer import LocalIssuer
+    from benchmark.harness import ServerThread, configure_environment, summarize_ms
+
+    issuer = LocalIssuer()
+    stand_in = FastAPI()
+    stand_in.include_router(FakeOpenAI().router)
+    stand_in.include_router(issuer.router)
+    stand_in_server = ServerThread(stand_in)
+    stand_in_server.start()
+    configure_environment(stand_in_server.url, issuer.audience, issuer.issuer, args.mongo_uri, False)
+
+    runs = []
+    try:
+        for index in range(args.runs):
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                port = probe.getsockname()[1]
+            run = measure(port, not args.mongo_uri, issuer.token("benchmark|startup"), args.timeout)
+            runs.append(run)
+            print(f"run {index + 1}: import {run['import_s']}s, create_app {run['create_app_s']}s, "
+                  f"first response {run['first_response_s']}s, first request {run['first_request_s']}s, "
+                  f"ready {run['ready_s']}s")
+    finally:
+        stand_in_server.stop()
+
+    summary = {name: summarize_ms([run[name] for run in runs]) for name in runs[0]} if runs else {}
+    for name, stats in summary.items():
+        print(f"{name:<18} p50 {stats['p50']:>9.1f} ms  max {stats['max']:>9.1f} ms")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"commit": git_commit(), "config": {"runs": args.runs, "mongo": bool(args.mongo_uri)},
+                       "runs": runs, "summary_ms": summary}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
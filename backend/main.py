@@ -1,61 +1,189 @@
+import time
+import asyncio
+import logging
+import importlib
+from functools import partial
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Literal, Optional, Type
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from openai import AsyncOpenAI
 from pydantic_settings import BaseSettings
-from haystack.utils import Secret
 
-from api.controller import WorkoutController, ExerciseController
-from api.auth import TokenVerifier
-from storage.repository import WorkoutRepository, ExerciseRepository
-from agent.assisant import WorkoutAssistantAgent, FuncTool
-from agent.pipeline import MongoDBRetrievalPipeline, MongoDBAtlasDocumentStore
-from schema.model import Workout, ExerciseInWorkout
+from api.health import HealthController
+from storage.mongo import MongoStorage
+from schema.param import PlanningMode
+from observability.tracing import TraceMiddleware, configure_logging
+
 
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# imported at startup rather than with this module, so tools and tests that only need the settings stay fast
+COMPONENT_MODULES = (
+    "agent.assisant",
+    "agent.pipeline",
+    "api.controller",
+    "observability.pipeline_tracing",
+)
 
 
 class Settings(BaseSettings):
     mongo_uri: str
     mongo_db_name: str
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 10
+    mongo_max_idle_time_ms: Optional[int] = None
+    mongo_connect_timeout_ms: int = 20000
+    mongo_server_selection_timeout_ms: int = 30000
     openai_key: str
+    openai_requests_per_minute: int = 500
+    openai_tokens_per_minute: int = 200000
+    openai_max_concurrency: int = 32
+    openai_max_retries: int = 5
     auth0_domain: str
     auth0_api_audience: str
     auth0_issuer: str
     auth0_algorithms: str
+    auth0_jwks_url: Optional[str] = None
+    jwks_ttl_seconds: float = 600
+    token_cache_size: int = 10000
+    plan_cache_enabled: bool = True
+    plan_cache_ttl_seconds: float = 7 * 24 * 3600
+    plan_cache_size: int = 1024
+    plan_cache_record_requests: bool = True
+    workout_cache_enabled: bool = True
+    workout_cache_ttl_seconds: float = 60
+    workout_cache_size: int = 10000
+    workout_cache_change_stream: bool = False
+    agent_max_turns: int = 3
+    agent_max_workers: int = 8
+    agent_memory_token_budget: int = 2000
+    planning_mode: PlanningMode = PlanningMode.AGENT
+    structured_max_repairs: int = 1
+    embedding_cache_size: int = 4096
+    embedding_cache_path: Optional[str] = None
+    embedding_batch_size: int = 256
+    exercise_retriever: Literal["atlas", "numpy"] = "atlas"
+    exercise_index_snapshot: Optional[str] = None
+    job_store: Literal["memory", "mongo"] = "memory"
+    job_concurrency: int = 4
+    job_queue_size: int = 100
+    idempotency_enabled: bool = True
+    idempotency_key_ttl_seconds: float = 24 * 3600
+    idempotency_fallback_ttl_seconds: float = 600
+    idempotency_max_keys: int = 10000
+    log_level: str = "INFO"
+    trace_ids: bool = True
+    warmup_enabled: bool = True
 
     class Config:
         env_file = ".env"
 
 
-def main():
-    settings = Settings()
+def import_components():
+    for module in COMPONENT_MODULES:
+        importlib.import_module(module)
+
+
+def wire(app: FastAPI, settings: Settings, storage: MongoStorage) -> Dict[str, Callable]:
+    """Builds the agent, pipelines and controllers and mounts their routes, returning the warm-up steps"""
+    from haystack import tracing
+    from haystack.utils import Secret
+
+    from api.controller import WorkoutController, ExerciseController, MetricsController
+    from api.auth import TokenVerifier
+    from storage.jobs import InMemoryJobStore, MongoJobStore
+    from storage.repository import WorkoutRepository, ExerciseRepository, WorkoutPlanRepository
+    from storage.workout_cache import CachedWorkoutRepository
+    from agent.assisant import WorkoutAssistantAgent, FuncTool, current_run
+    from agent.context import ContextWindow, compact_exercise_groups
+    from agent.plan_cache import PlanCache
+    from agent.jobs import WorkoutJobQueue
+    from agent.idempotency import SingleFlight
+    from agent.rate_limit import OpenAIRateLimiter, Priority, async_openai_client, openai_client
+    from agent.pipeline import MongoDBRetrievalPipeline, SharedClientDocumentStore
+    from agent.embedding_cache import EmbeddingCache
+    from agent.vector_index import ExerciseVectorIndex, NumpyEmbeddingRetriever
+    from schema.model import Workout, ExerciseInWorkout
+    from observability.pipeline_tracing import ComponentTimingTracer
+
+    tracing.enable_tracing(ComponentTimingTracer())
     mongo_uri, mongo_db_name = settings.mongo_uri, settings.mongo_db_name
-    openai_async_client = AsyncOpenAI()
+    openai_limiter = OpenAIRateLimiter(
+        requests_per_minute=settings.openai_requests_per_minute,
+        tokens_per_minute=settings.openai_tokens_per_minute,
+        max_concurrency=settings.openai_max_concurrency,
+        max_retries=settings.openai_max_retries,
+    )
+    # chat turns and the embeddings of their searches go ahead of exercise ingestion
+    openai_interactive_client = openai_client(openai_limiter, Priority.INTERACTIVE)
+    openai_async_client = async_openai_client(openai_limiter, Priority.BULK)
+    app.add_event_handler("startup", openai_limiter.start)
+    app.add_event_handler("shutdown", openai_interactive_client.close)
+    app.add_event_handler("shutdown", openai_async_client.close)
     token_verifier = TokenVerifier(
         settings.auth0_domain,
         settings.auth0_api_audience,
         settings.auth0_issuer,
-        settings.auth0_algorithms
+        settings.auth0_algorithms,
+        jwks_url=settings.auth0_jwks_url,
+        jwks_ttl=settings.jwks_ttl_seconds,
+        token_cache_size=settings.token_cache_size,
     )
-    workout_repository = WorkoutRepository(
-        mongo_uri, mongo_db_name, "workouts")
-    exercise_rag = MongoDBRetrievalPipeline(store=MongoDBAtlasDocumentStore(
-        mongo_connection_string=Secret.from_token(mongo_uri),
-        database_name=mongo_db_name,
-        collection_name="exercises",
-        vector_search_index="vector_search"
-        ))
-    query_exercise_tool = FuncTool(
-        name="query_exercise",
-        desc="use this function to semantically search the exercise database for a list of matching exercises with a query",
-        func=exercise_rag.query,
+    if settings.workout_cache_enabled:
+        workout_repository = storage.repository(partial(
+            CachedWorkoutRepository,
+            ttl_seconds=settings.workout_cache_ttl_seconds,
+            max_size=settings.workout_cache_size,
+            watch_changes=settings.workout_cache_change_stream,
+        ), "workouts")
+        app.add_event_handler("startup", workout_repository.start)
+        app.add_event_handler("shutdown", workout_repository.stop)
+    else:
+        workout_repository = storage.repository(WorkoutRepository, "workouts")
+    exercise_repository = storage.repository(ExerciseRepository, "exercises")
+    embedding_cache = EmbeddingCache(
+        settings.embedding_cache_size, settings.embedding_cache_path)
+    if settings.exercise_retriever == "numpy":
+        vector_index = ExerciseVectorIndex()
+        exercise_rag = MongoDBRetrievalPipeline(
+            embedding_cache=embedding_cache, retriever=NumpyEmbeddingRetriever(vector_index),
+            openai_client=openai_interactive_client)
+
+        async def load_vector_index():
+            snapshot = settings.exercise_index_snapshot
+            # the snapshot stands in for Mongo only while it holds exactly the exercises stored there,
+            # other workers and migrate_embeddings.py may have written since it was saved
+            if not (snapshot and vector_index.load_snapshot(snapshot, await exercise_repository.embeddings_digest())):
+                await vector_index.load(exercise_repository)
+
+        def save_vector_index():
+            if settings.exercise_index_snapshot:
+                vector_index.save_snapshot(settings.exercise_index_snapshot)
+
+        app.add_event_handler("startup", load_vector_index)
+        app.add_event_handler("shutdown", save_vector_index)
+    else:
+        vector_index = None
+        exercise_rag = MongoDBRetrievalPipeline(store=SharedClientDocumentStore(
+            storage.sync_client,
+            mongo_connection_string=Secret.from_token(mongo_uri),
+            database_name=mongo_db_name,
+            collection_name="exercises",
+            vector_search_index="vector_search"
+            ), embedding_cache=embedding_cache, openai_client=openai_interactive_client)
+    query_exercises_tool = FuncTool(
+        name="query_exercises",
+        desc="use this function to semantically search the exercise database with several queries at once, for example one per muscle group or training focus. it returns the matching exercises grouped by query",
+        func=exercise_rag.query_many,
+        event="exercises_retrieved",
+        compact=compact_exercise_groups,
         params={
                 "type": "object",
                 "properties": {
-                    "query": {"type": "string"},
+                    "queries": {"type": "array", "items": {"type": "string"}, "minItems": 1, "maxItems": 8},
                 },
-                "required": ["query"],
+                "required": ["queries"],
                 "additionalProperties": False,
             },
     )
@@ -67,26 +195,146 @@ def main():
             target_muscle_groups=target_muscle_groups,
             total_calories_burned=total_calories_burned,
         )
-        workout_id = await workout_repository.add(workout=workout)
-        return True
+        run = current_run.get()
+        workout_id = await workout_repository.add(workout, run.run_id if run else None)
+        if run:
+            run.workouts.append((workout_id, workout))
+        return {"id": workout_id}
     
     add_workout_tool = FuncTool(
-        name="async_add_workout",
-        desc="use this function to add a workout to the workout database. it will return true if successfully the workout is successfully added",
+        name="add_workout",
+        desc="use this function to add a workout to the workout database. it will return the id of the workout if it is successfully added",
         func=add_workout,
+        event="workout_persisted",
         params=Workout.model_json_schema()
     )
 
 
-    agent = WorkoutAssistantAgent(tools=[query_exercise_tool, add_workout_tool])
+    plan_cache = None
+    if settings.plan_cache_enabled:
+        plan_cache = PlanCache(
+            storage.repository(WorkoutPlanRepository, "workout_plans"),
+            workout_repository,
+            ttl_seconds=settings.plan_cache_ttl_seconds,
+            max_size=settings.plan_cache_size,
+            record_requests=settings.plan_cache_record_requests,
+        )
+    agent = WorkoutAssistantAgent(
+        tools=[query_exercises_tool, add_workout_tool],
+        max_turns=settings.agent_max_turns,
+        max_workers=settings.agent_max_workers,
+        plan_cache=plan_cache,
+        context=ContextWindow(settings.agent_memory_token_budget),
+        retrieve=exercise_rag.query_many,
+        workouts=workout_repository,
+        max_repairs=settings.structured_max_repairs,
+        planning_mode=settings.planning_mode,
+        openai_client=openai_interactive_client,
+    )
+    app.state.agent = agent
+    app.state.workout_repository = workout_repository
+    if settings.job_store == "mongo":
+        job_store = storage.repository(MongoJobStore, "workout_jobs")
+    else:
+        job_store = InMemoryJobStore()
+    job_queue = WorkoutJobQueue(
+        agent, job_store, concurrency=settings.job_concurrency, max_queue_size=settings.job_queue_size)
+    idempotency = None
+    if settings.idempotency_enabled:
+        idempotency = SingleFlight(settings.idempotency_key_ttl_seconds, settings.idempotency_max_keys)
     workout_controller = WorkoutController(
-        workout_repository, agent, token_verifier)
-    exercise_repository = ExerciseRepository(
-        mongo_uri, mongo_db_name, "exercises")
+        workout_repository, agent, token_verifier, job_queue, idempotency,
+        settings.idempotency_fallback_ttl_seconds)
     exercise_controller = ExerciseController(
-        exercise_repository, openai_async_client)
+        exercise_repository, openai_async_client, embedding_cache, vector_index,
+        settings.embedding_batch_size)
+    app.add_event_handler("shutdown", token_verifier.close)
+    app.add_event_handler("startup", job_queue.start)
+    app.add_event_handler("shutdown", job_queue.stop)
+    if plan_cache is not None:
+        app.add_event_handler("startup", plan_cache.start)
+        app.add_event_handler("shutdown", plan_cache.stop)
+    app.add_event_handler("shutdown", agent.close)
+    app.add_event_handler("shutdown", exercise_rag.close)
+    app.add_event_handler("shutdown", embedding_cache.close)
     app.include_router(workout_controller.router, prefix="/api")
     app.include_router(exercise_controller.router, prefix="/api")
+    app.include_router(MetricsController().router)
+
+    warmups: Dict[str, Callable] = {
+        # verify() fetches the keys on demand, so the JWKS round trip need not hold up startup
+        "jwks": token_verifier.start,
+        "retrieval pipeline": exercise_rag.warm_up,
+        "openapi schema": app.openapi,
+    }
+    if vector_index is not None:
+        warmups["vector index"] = partial(vector_index.search, [0.0] * vector_index.dim)
+    return warmups
+
+
+async def warm_up(app: FastAPI, steps: Dict[str, Callable]):
+    for name, step in steps.items():
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(step):
+                await step()
+            else:
+                await asyncio.to_thread(step)
+        except Exception:
+            logger.exception("warm-up step %s failed", name)
+            continue
+        logger.info("warmed up %s in %.3fs", name, time.perf_counter() - started)
+    app.state.health.is_ready = True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings: Settings = app.state.settings
+    storage: MongoStorage = app.state.storage
+    started = time.perf_counter()
+    # the heavy imports hold the GIL only part of the time, the Mongo handshakes overlap with them
+    await asyncio.gather(asyncio.to_thread(import_components), storage.connect())
+    warmups = wire(app, settings, storage)
+    await storage.ensure_indexes()
+    await app.router.startup()
+    logger.info("started in %.3fs", time.perf_counter() - started)
+    warmup = None
+    if settings.warmup_enabled:
+        warmup = asyncio.create_task(warm_up(app, warmups))
+    else:
+        app.state.health.is_ready = True
+    try:
+        yield
+    finally:
+        if warmup:
+            warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+        await app.router.shutdown()
+        storage.close()
+        app.state.log_listener.stop()
+
+
+def create_app(settings: Optional[Settings] = None, storage_cls: Type[MongoStorage] = MongoStorage) -> FastAPI:
+    """
+    The app with its middleware and health routes. Everything that needs haystack or OpenAI is imported and
+    built during lifespan startup, and /health/ready reports ready once the optional warm-up has run.
+    """
+    settings = settings or Settings()
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+    app.state.log_listener = configure_logging(settings.log_level)
+    app.state.storage = storage_cls(
+        settings.mongo_uri,
+        settings.mongo_db_name,
+        max_pool_size=settings.mongo_max_pool_size,
+        min_pool_size=settings.mongo_min_pool_size,
+        max_idle_time_ms=settings.mongo_max_idle_time_ms,
+        connect_timeout_ms=settings.mongo_connect_timeout_ms,
+        server_selection_timeout_ms=settings.mongo_server_selection_timeout_ms,
+    )
+    app.state.health = HealthController()
+    app.include_router(app.state.health.router)
+    app.add_middleware(TraceMiddleware, trace_ids=settings.trace_ids)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -94,9 +342,9 @@ def main():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    return app
 
 
 if __name__ == "__main__":
-    main()
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(create_app(), host="0.0.0.0", port=8000)
@@ -0,0 +1,41 @@
+import asyncio
+import argparse
+from typing import Dict
+
+import main
+from storage.mongo import MongoStorage
+from storage.repository import ExerciseRepository
+
+
+def describe(stats: Dict[str, int]) -> str:
+    sizes = ", ".join(f"{key.replace('_', ' ')} {value / 1024 / 1024:.2f} MiB"
+                      for key, value in stats.items() if key in ("size", "storage_size"))
+    return f"{stats['count']} exercises, {sizes}, {stats['avg_document_size']} bytes per document"
+
+
+async def migrate(batch_size: int):
+    settings = main.Settings()
+    storage = MongoStorage(settings.mongo_uri, settings.mongo_db_name, min_pool_size=0)
+    repository = storage.repository(ExerciseRepository, "exercises")
+    try:
+        before = await repository.storage_stats()
+        print(f"before: {describe(before)}")
+        converted = 0
+        async for batch in repository.pack_embeddings(batch_size):
+            converted += batch
+            print(f"packed {converted} embeddings")
+        # WiredTiger keeps the freed pages, the storage size only shrinks once the collection is compacted
+        after = await repository.storage_stats()
+        print(f"after:  {describe(after)}")
+        if before["size"]:
+            print(f"converted {converted} exercises, data size {100 * (1 - after['size'] / before['size']):.1f}% smaller")
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rewrite exercise embeddings stored as arrays of doubles as packed float32 BSON vectors")
+    parser.add_argument("--batch-size", type=int, default=500, help="documents rewritten per bulk write")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.batch_size))
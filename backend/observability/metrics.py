@@ -0,0 +1,89 @@
+import time
+import inspect
+from functools import wraps
+from typing import Any, Dict
+
+from prometheus_client import Counter, Gauge, Histogram
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "workout_stage_duration_seconds", "Duration of a stage of serving a request", ["stage"],
+    buckets=LATENCY_BUCKETS)
+PIPELINE_COMPONENT_SECONDS = Histogram(
+    "pipeline_component_duration_seconds", "Duration of a haystack component run", ["component"],
+    buckets=LATENCY_BUCKETS)
+TOOL_CALL_SECONDS = Histogram(
+    "agent_tool_call_duration_seconds", "Duration of an agent tool call", ["tool"],
+    buckets=LATENCY_BUCKETS)
+REPOSITORY_SECONDS = Histogram(
+    "repository_operation_duration_seconds", "Duration of a repository method", ["repository", "operation"],
+    buckets=LATENCY_BUCKETS)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Duration of an HTTP request until its response started",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+LLM_TURNS = Histogram(
+    "agent_llm_turns", "LLM calls made to answer one chat", buckets=(1, 2, 3, 4, 5, 6, 8))
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens reported by the LLM", ["model", "type"])
+CONTEXT_TOKENS = Counter(
+    "agent_context_tokens_total", "Prompt tokens the agent sent, and those context compaction saved", ["type"])
+OPENAI_QUEUE_DEPTH = Gauge(
+    "openai_queue_depth", "OpenAI requests waiting for admission by the rate limiter", ["lane"])
+OPENAI_WAIT_SECONDS = Histogram(
+    "openai_queue_wait_seconds", "Time an OpenAI request waited for admission", ["lane"], buckets=LATENCY_BUCKETS)
+OPENAI_IN_FLIGHT = Gauge(
+    "openai_requests_in_flight", "OpenAI requests admitted and not yet finished")
+OPENAI_CONCURRENCY_LIMIT = Gauge(
+    "openai_concurrency_limit", "Current adaptive limit on concurrent OpenAI requests")
+OPENAI_RETRIES = Counter(
+    "openai_retries_total", "OpenAI requests retried, by the status or error that caused it", ["lane", "reason"])
+EMBEDDING_CACHE = Counter(
+    "embedding_cache_lookups_total", "Embedding cache lookups by result: memory hit, file hit, miss or coalesced",
+    ["result"])
+WORKOUT_CACHE = Counter(
+    "workout_cache_requests_total", "Workout cache lookups by result", ["result"])
+
+
+def timed(histogram: Histogram, **labels: str):
+    """Decorator observing the duration of a sync or async function on the labelled histogram"""
+    observer = histogram.labels(**labels)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observer.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observer.observe(time.perf_counter() - started)
+        return wrapper
+
+    return decorator
+
+
+def timed_repository(cls):
+    """Class decorator timing every public coroutine method of a repository"""
+    for name, member in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(member):
+            setattr(cls, name, timed(REPOSITORY_SECONDS, repository=cls.__name__, operation=name)(member))
+    return cls
+
+
+def record_token_usage(meta: Dict[str, Any]):
+    usage = meta.get("usage") or {}
+    model = meta.get("model") or "unknown"
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            LLM_TOKENS.labels(model=model, type=kind.removesuffix("_tokens")).inc(usage[kind])
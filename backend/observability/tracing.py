@@ -0,0 +1,83 @@
+import sys
+import time
+import uuid
+import queue
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from observability.metrics import HTTP_REQUEST_SECONDS
+
+
+TRACE_HEADER = "X-Request-ID"
+
+trace_id: ContextVar[str] = ContextVar("trace_id", default="-")
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id.get()
+        return True
+
+
+def configure_logging(level: str = "INFO") -> logging.handlers.QueueListener:
+    """
+    Routes log records through a queue to a listener thread, so handlers never write to stdout from the
+    event loop. Records carry the trace id of the request they were logged in.
+    """
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"))
+    listener = logging.handlers.QueueListener(records, stream)
+
+    handler = logging.handlers.QueueHandler(records)
+    # the filter runs before the record leaves the request's context
+    handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # httpx logs every request at INFO, including each OpenAI call
+    logging.getLogger("httpx").setLevel(max(root.level, logging.WARNING))
+    listener.start()
+    return listener
+
+
+class TraceMiddleware:
+    """
+    Records each request's latency by route template and, with trace_ids, gives the request a trace id
+    taken from the X-Request-ID header or generated, and echoes it on the response.
+    """
+
+    def __init__(self, app: ASGIApp, trace_ids: bool = True):
+        self.app = app
+        self.trace_ids = trace_ids
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_trace_id = None
+        if self.trace_ids:
+            request_trace_id = next((value.decode() for name, value in scope["headers"]
+                                     if name == TRACE_HEADER.lower().encode()), None) or uuid.uuid4().hex
+        token = trace_id.set(request_trace_id or "-")
+        started = time.perf_counter()
+
+        async def send_with_trace_id(message: Message):
+            if message["type"] == "http.response.start":
+                if request_trace_id:
+                    message["headers"] = [*message.get("headers", []),
+                                          (TRACE_HEADER.lower().encode(), request_trace_id.encode())]
+                route = scope.get("route")
+                HTTP_REQUEST_SECONDS.labels(
+                    method=scope["method"], route=route.path if route else "unmatched", status=str(message["status"]),
+                ).observe(time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            trace_id.reset(token)
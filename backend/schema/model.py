@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 from datetime import datetime
 from enum import Enum
 
@@ -21,8 +21,10 @@ class Exercise(BaseModel):
         default=None, description="URL to a demonstration video")
     tags: List[str] = Field(default_factory=list,
                             description="Tags for categorization")
-    embedding: SkipJsonSchema[List[float]] = []
+    # a packed float32 BSON vector once stored, see storage.vectors; arrays of doubles until migrated
+    embedding: SkipJsonSchema[Union[bytes, List[float], None]] = None
     content: SkipJsonSchema[str] = ""
+    content_hash: SkipJsonSchema[str] = ""
 
 
 class ExerciseInWorkout(BaseModel):
@@ -84,3 +86,19 @@ class Questionnaire(BaseModel):
     has_equipment: bool
     experience_level: ExperienceLevel
     workout_duration: int = Field(..., gt=0)
+
+
+class WorkoutJob(BaseModel):
+    class Status(str, Enum):
+        QUEUED = "queued"
+        RUNNING = "running"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+
+    id: str
+    user_id: str
+    status: Status = Status.QUEUED
+    workout_id: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class PlanningMode(str, Enum):
+    AGENT = "agent"
+    STRUCTURED = "structured"
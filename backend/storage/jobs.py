@@ -0,0 +1,69 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING, IndexModel
+
+from schema.model import WorkoutJob
+from observability.metrics import timed_repository
+
+
+class JobStore(ABC):
+    @abstractmethod
+    async def create(self, job: WorkoutJob) -> None:
+        ...
+
+    @abstractmethod
+    async def update(self, job_id: str, **fields) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[WorkoutJob]:
+        ...
+
+
+class InMemoryJobStore(JobStore):
+    """Job state local to the process, keeping the most recent max_jobs jobs"""
+
+    def __init__(self, max_jobs: int = 10000):
+        self.max_jobs = max_jobs
+        self.jobs: OrderedDict[str, WorkoutJob] = OrderedDict()
+
+    async def create(self, job: WorkoutJob) -> None:
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+
+    async def update(self, job_id: str, **fields) -> None:
+        if job_id in self.jobs:
+            self.jobs[job_id] = self.jobs[job_id].model_copy(update={**fields, "updated_at": datetime.utcnow()})
+
+    async def get(self, job_id: str) -> Optional[WorkoutJob]:
+        return self.jobs.get(job_id)
+
+
+@timed_repository
+class MongoJobStore(JobStore):
+    """Job state shared by every worker process, expired a day after the job was created"""
+    indexes = [IndexModel([("created_at", ASCENDING)], expireAfterSeconds=24 * 3600)]
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def create(self, job: WorkoutJob) -> None:
+        job_dict = job.model_dump(exclude={"id"})
+        job_dict["_id"] = job.id
+        await self.collection.insert_one(job_dict)
+
+    async def update(self, job_id: str, **fields) -> None:
+        await self.collection.update_one(
+            {"_id": job_id}, {"$set": {**fields, "updated_at": datetime.utcnow()}})
+
+    async def get(self, job_id: str) -> Optional[WorkoutJob]:
+        job_dict = await self.collection.find_one({"_id": job_id})
+        if job_dict:
+            job_dict["id"] = str(job_dict.pop("_id"))
+            return WorkoutJob(**job_dict)
+        return None
@@ -0,0 +1,63 @@
+import asyncio
+from typing import List, Optional, Type, TypeVar
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+
+
+R = TypeVar("R")
+
+
+class MongoStorage:
+    """
+    Owns the single motor client of the process. Repositories are created through it so their
+    indexes can be ensured, and the connection pool warmed, before the app starts serving.
+    """
+
+    def __init__(self,
+                 mongo_uri: str,
+                 db_name: str,
+                 max_pool_size: int = 100,
+                 min_pool_size: int = 10,
+                 max_idle_time_ms: Optional[int] = None,
+                 connect_timeout_ms: int = 20000,
+                 server_selection_timeout_ms: int = 30000):
+        self.client = AsyncIOMotorClient(
+            mongo_uri,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            maxIdleTimeMS=max_idle_time_ms,
+            connectTimeoutMS=connect_timeout_ms,
+            serverSelectionTimeoutMS=server_selection_timeout_ms,
+        )
+        self.db = self.client[db_name]
+        self.min_pool_size = min_pool_size
+        self.repositories: List = []
+
+    @property
+    def sync_client(self) -> MongoClient:
+        """The pymongo client behind motor, for synchronous libraries that should share the pool"""
+        return self.client.delegate
+
+    def repository(self, repository_cls: Type[R], collection_name: str) -> R:
+        repository = repository_cls(self.db[collection_name])
+        self.repositories.append(repository)
+        return repository
+
+    async def connect(self):
+        await self.client.admin.command("ping")
+        # concurrent round trips check out distinct connections, leaving them open in the pool
+        await asyncio.gather(*(self.client.admin.command("ping") for _ in range(self.min_pool_size)))
+
+    async def ensure_indexes(self):
+        await asyncio.gather(*(
+            repository.collection.create_indexes(repository.indexes)
+            for repository in self.repositories if repository.indexes
+        ))
+
+    async def start(self):
+        await self.connect()
+        await self.ensure_indexes()
+
+    def close(self):
+        self.client.close()
@@ -1,66 +1,279 @@
-from typing import List, Optional
+import bson
+import base64
+import hashlib
+import binascii
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
 from bson import ObjectId
-from motor.motor_asyncio import AsyncIOMotorClient
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from schema.model import Workout, Exercise, ExerciseInWorkout, Questionnaire
+from storage.vectors import as_bson_vector, unpack_float32
+from observability.metrics import timed_repository
+
+
+def encode_cursor(last_id: Any) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode(), altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def page_filter(filters: Dict[str, Any], after: Any = None) -> Dict[str, Any]:
+    query = {field: value for field, value in filters.items() if value is not None}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    return query
+
+
+async def with_ids(documents) -> AsyncIterator[Dict[str, Any]]:
+    async for document in documents:
+        document["id"] = str(document.pop("_id"))
+        yield document
+
 
-from schema.model import Workout, Exercise
+async def page(documents, limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Up to limit documents of a cursor fetching limit + 1, and the cursor of the next page if there is one"""
+    documents = [document async for document in with_ids(documents.limit(limit + 1))]
+    if len(documents) > limit:
+        return documents[:limit], encode_cursor(documents[limit - 1]["id"])
+    return documents, None
 
 
+def construct_workout(workout_dict: Dict[str, Any]) -> Workout:
+    """A Workout from a document written from a validated one, which needs no validation on the way back"""
+    exercises = [ExerciseInWorkout.model_construct(**exercise) for exercise in workout_dict.pop("exercises")]
+    return Workout.model_construct(exercises=exercises, **workout_dict)
+
+
+@timed_repository
 class WorkoutRepository:
-    def __init__(self, mongo_uri: str, db_name: str, collection_name: str):
-        self.client = AsyncIOMotorClient(mongo_uri)
-        self.db = self.client[db_name]
-        self.collection = self.db[collection_name]
+    indexes = [
+        IndexModel([("user_id", ASCENDING)]),
+        IndexModel([("run_id", ASCENDING)], unique=True, sparse=True),
+    ]
+
+    projection = {"run_id": 0}
 
-    async def add(self, workout: Workout) -> str:
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    async def add(self, workout: Workout, run_id: Optional[str] = None) -> str:
+        """Inserts the workout, or with a run id upserts the one workout that run stores"""
         workout_dict = workout.model_dump(exclude={"id"})
-        result = await self.collection.insert_one(workout_dict)
-        return str(result.inserted_id)
+        if run_id is None:
+            result = await self.collection.insert_one(workout_dict)
+            return str(result.inserted_id)
+        for attempt in range(2):
+            try:
+                stored = await self.collection.find_one_and_update(
+                    {"run_id": run_id}, {"$set": workout_dict}, projection={"_id": 1}, upsert=True,
+                    return_document=ReturnDocument.AFTER)
+                return str(stored["_id"])
+            except DuplicateKeyError:
+                # a concurrent upsert of the same run inserted first, the retry updates its document
+                if attempt:
+                    raise
 
-    async def get(self, user_id: str) -> Optional[Workout]:
-        workout_dict = await self.collection.find_one({"user_id": user_id})
+    async def get_document(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """The user's workout as the plain dict a Workout dumps to, read without building the model"""
+        workout_dict = await self.collection.find_one({"user_id": user_id}, self.projection)
         if workout_dict:
             workout_dict["id"] = str(workout_dict.pop("_id"))
-            return Workout(**workout_dict)
-        return None
+        return workout_dict
 
-    async def list_all(self) -> List[Workout]:
-        workouts = []
-        async for workout_dict in self.collection.find():
-            workout_dict["id"] = str(workout_dict.pop("_id"))
-            workouts.append(Workout(**workout_dict))
-        return workouts
+    def _find(self, cursor: Optional[str], user_id: Optional[str], muscle_group: Optional[str]):
+        after = None
+        if cursor:
+            try:
+                after = ObjectId(decode_cursor(cursor))
+            except InvalidId:
+                raise ValueError("Invalid cursor")
+        query = page_filter({"user_id": user_id, "target_muscle_groups": muscle_group}, after)
+        return self.collection.find(query, self.projection).sort("_id", 1)
+
+    async def list_page_documents(self, limit: int, cursor: Optional[str] = None, user_id: Optional[str] = None,
+                                  muscle_group: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """A page of workouts as plain dicts, read without building models"""
+        return await page(self._find(cursor, user_id, muscle_group), limit)
+
+    def stream(self, cursor: Optional[str] = None, user_id: Optional[str] = None,
+               muscle_group: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        return with_ids(self._find(cursor, user_id, muscle_group))
 
     async def remove(self, workout_id: str) -> bool:
         result = await self.collection.delete_one({"_id": ObjectId(workout_id)})
         return result.deleted_count > 0
 
 
+@timed_repository
 class ExerciseRepository:
-    def __init__(self, mongo_uri: str, db_name: str, collection_name: str):
-        self.client = AsyncIOMotorClient(mongo_uri)
-        self.db = self.client[db_name]
-        self.collection = self.db[collection_name]
+    indexes = [
+        IndexModel([("muscle_groups", ASCENDING)]),
+        IndexModel([("difficulty", ASCENDING)]),
+        IndexModel([("equipments", ASCENDING)]),
+    ]
+    list_projection = {"embedding": 0, "content": 0, "content_hash": 0}
+    detail_projection = {"embedding": 0, "content_hash": 0}
+    # missing and null embeddings both fail $ne: null
+    embedded = {"embedding": {"$ne": None}}
 
-    async def add(self, exercise: Exercise) -> str:
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    @staticmethod
+    def _document(exercise: Exercise) -> Dict[str, Any]:
         exercise_dict = exercise.model_dump(exclude={"id"})
         exercise_dict["_id"] = exercise_dict["name"]
-        result = await self.collection.insert_one(exercise_dict)
+        exercise_dict["embedding"] = as_bson_vector(exercise_dict["embedding"])
+        return exercise_dict
+
+    async def add(self, exercise: Exercise) -> str:
+        result = await self.collection.insert_one(self._document(exercise))
         return str(result.inserted_id)
 
-    async def get(self, exercise_id: str) -> Optional[Exercise]:
-        exercise_dict = await self.collection.find_one({"_id": exercise_id})
+    async def add_many(self, exercises: List[Exercise]) -> Dict[int, str]:
+        """Upserts exercises by name in one unordered bulk write, returns the write errors by position"""
+        requests = []
+        for exercise in exercises:
+            exercise_dict = self._document(exercise)
+            requests.append(ReplaceOne({"_id": exercise_dict["_id"]}, exercise_dict, upsert=True))
+        if not requests:
+            return {}
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as err:
+            return {error["index"]: error["errmsg"] for error in err.details["writeErrors"]}
+        return {}
+
+    async def content_hashes(self, exercise_ids: List[str]) -> Dict[str, str]:
+        hashes = {}
+        async for exercise_dict in self.collection.find({"_id": {"$in": exercise_ids}}, {"content_hash": 1}):
+            hashes[str(exercise_dict["_id"])] = exercise_dict.get("content_hash", "")
+        return hashes
+
+    async def get_document(self, exercise_id: str) -> Optional[Dict[str, Any]]:
+        """The exercise as a plain dict without its embedding and content hash, read without building the model"""
+        exercise_dict = await self.collection.find_one({"_id": exercise_id}, self.detail_projection)
         if exercise_dict:
             exercise_dict["id"] = str(exercise_dict.pop("_id"))
-            return Exercise(**exercise_dict)
-        return None
+        return exercise_dict
 
-    async def list_all(self) -> List[Exercise]:
-        exercises = []
-        async for exercise_dict in self.collection.find():
-            exercise_dict["id"] = str(exercise_dict.pop("_id"))
-            exercises.append(Exercise(**exercise_dict))
-        return exercises
+    def _find(self, cursor: Optional[str], muscle_group: Optional[str], difficulty: Optional[str],
+              equipment: Optional[str]):
+        query = page_filter({"muscle_groups": muscle_group, "difficulty": difficulty, "equipments": equipment},
+                            decode_cursor(cursor) if cursor else None)
+        return self.collection.find(query, self.list_projection).sort("_id", 1)
+
+    async def list_page_documents(self, limit: int, cursor: Optional[str] = None, muscle_group: Optional[str] = None,
+                                  difficulty: Optional[str] = None,
+                                  equipment: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """A page of exercises as plain dicts in the list projection, read without building models"""
+        return await page(self._find(cursor, muscle_group, difficulty, equipment), limit)
+
+    def stream(self, cursor: Optional[str] = None, muscle_group: Optional[str] = None,
+               difficulty: Optional[str] = None,
+               equipment: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        return with_ids(self._find(cursor, muscle_group, difficulty, equipment))
+
+    async def iter_embeddings(self) -> AsyncIterator[Tuple[str, str, np.ndarray]]:
+        async for exercise_dict in self.collection.find(self.embedded, {"content": 1, "embedding": 1}):
+            embedding = exercise_dict.get("embedding")
+            if embedding is None or len(embedding) == 0:
+                continue
+            yield str(exercise_dict["_id"]), exercise_dict.get("content", ""), unpack_float32(embedding)
+
+    async def embeddings_digest(self) -> str:
+        """A digest of the embedded exercises' ids and content hashes, which changes whenever one is re-embedded"""
+        digest = hashlib.sha256()
+        async for exercise_dict in self.collection.find(self.embedded, {"content_hash": 1}).sort("_id", 1):
+            digest.update(f"{exercise_dict['_id']}\0{exercise_dict.get('content_hash', '')}\n".encode())
+        return digest.hexdigest()
+
+    async def pack_embeddings(self, batch_size: int = 500) -> AsyncIterator[int]:
+        """Rewrites embeddings still stored as arrays of doubles as packed float32 vectors, yielding each batch's size"""
+        requests = []
+        async for exercise_dict in self.collection.find({"embedding.0": {"$exists": True}}, {"embedding": 1}).batch_size(batch_size):
+            requests.append(UpdateOne({"_id": exercise_dict["_id"], "embedding.0": {"$exists": True}},
+                                      {"$set": {"embedding": as_bson_vector(exercise_dict["embedding"])}}))
+            if len(requests) == batch_size:
+                await self.collection.bulk_write(requests, ordered=False)
+                yield len(requests)
+                requests = []
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
+            yield len(requests)
+
+    async def storage_stats(self) -> Dict[str, int]:
+        """Document count and sizes in bytes, from $collStats or, where that is unavailable, by encoding every document"""
+        try:
+            async for stats in self.collection.aggregate([{"$collStats": {"storageStats": {}}}]):
+                storage = stats["storageStats"]
+                return {"count": storage["count"], "size": storage["size"], "storage_size": storage["storageSize"],
+                        "avg_document_size": storage.get("avgObjSize", 0)}
+        except OperationFailure:
+            pass
+        count = size = 0
+        async for exercise_dict in self.collection.find({}):
+            count += 1
+            size += len(bson.encode(exercise_dict))
+        return {"count": count, "size": size, "avg_document_size": size // count if count else 0}
 
     async def remove(self, exercise_id: str) -> bool:
         result = await self.collection.delete_one({"_id": exercise_id})
         return result.deleted_count > 0
+
+
+@timed_repository
+class WorkoutPlanRepository:
+    """Generated workout templates keyed by questionnaire fingerprint and planning mode, with per-key request counts"""
+    indexes = [IndexModel([("requests", DESCENDING)])]
+
+    def __init__(self, collection: AsyncIOMotorCollection):
+        self.collection = collection
+
+    @staticmethod
+    def _plan(plan_dict: Optional[Dict[str, Any]]) -> Optional[Tuple[Workout, datetime]]:
+        if plan_dict and plan_dict.get("workout"):
+            # written from a validated Workout, which may legitimately hold None in non-optional fields
+            return construct_workout(plan_dict["workout"]), plan_dict["created_at"].replace(tzinfo=timezone.utc)
+        return None
+
+    async def get(self, fingerprint: str) -> Optional[Tuple[Workout, datetime]]:
+        return self._plan(await self.collection.find_one({"_id": fingerprint}))
+
+    async def record_requests(self, requests: Dict[str, Tuple[Questionnaire, int]]):
+        """Adds request counts per key, one upsert each in a single round trip"""
+        await self.collection.bulk_write([
+            UpdateOne({"_id": key},
+                      {"$inc": {"requests": count},
+                       "$setOnInsert": {"questionnaire": questionnaire.model_dump(mode="json")}},
+                      upsert=True)
+            for key, (questionnaire, count) in requests.items()
+        ], ordered=False)
+
+    async def put(self, fingerprint: str, questionnaire: Questionnaire, workout: Workout):
+        await self.collection.update_one(
+            {"_id": fingerprint},
+            {"$set": {
+                "questionnaire": questionnaire.model_dump(mode="json"),
+                "workout": workout.model_dump(exclude={"id", "user_id"}),
+                "created_at": datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
+
+    async def most_requested(self, limit: int) -> List[Questionnaire]:
+        questionnaires = []
+        async for plan_dict in self.collection.find({}, {"questionnaire": 1}).sort("requests", DESCENDING).limit(limit):
+            questionnaires.append(Questionnaire(**plan_dict["questionnaire"]))
+        return questionnaires
@@ -0,0 +1,42 @@
+from typing import Any, Optional, Sequence, Union
+
+import numpy as np
+from bson import Binary
+
+
+# BSON binary subtype for vectors, indexed by Atlas vector search like an array of numbers
+VECTOR_SUBTYPE = 9
+# dtype byte of float32 vectors, followed by the padding byte, always 0 for float32
+FLOAT32_HEADER = b"\x27\x00"
+
+Embedding = Union[bytes, Sequence[float]]
+
+
+def pack_float32(values: Sequence[float]) -> Binary:
+    """Packs an embedding as a little-endian float32 BSON vector, 4 bytes per dimension"""
+    return Binary(FLOAT32_HEADER + np.asarray(values, dtype="<f4").tobytes(), VECTOR_SUBTYPE)
+
+
+def as_bson_vector(embedding: Optional[Any]) -> Optional[Any]:
+    """What to store for an embedding: packed vectors as they are, lists of floats packed, nothing as nothing"""
+    if embedding is None or len(embedding) == 0:
+        return embedding
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        if bytes(embedding[:2]) != FLOAT32_HEADER:
+            raise ValueError("Not a packed float32 vector")
+        if isinstance(embedding, Binary) and embedding.subtype == VECTOR_SUBTYPE:
+            return embedding
+        return Binary(bytes(embedding), VECTOR_SUBTYPE)
+    return pack_float32(embedding)
+
+
+def unpack_float32(embedding: Embedding) -> np.ndarray:
+    """
+    A float32 array over the embedding. Packed vectors are viewed in place, read-only and without a copy;
+    embeddings still stored as arrays of doubles are converted.
+    """
+    if isinstance(embedding, (bytes, bytearray, memoryview)):
+        if bytes(embedding[:2]) != FLOAT32_HEADER:
+            raise ValueError("Not a packed float32 vector")
+        return np.frombuffer(embedding, dtype="<f4", offset=len(FLOAT32_HEADER))
+    return np.asarray(embedding, dtype=np.float32)
@@ -0,0 +1,141 @@
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+from schema.model import Workout
+from storage.repository import WorkoutRepository
+from observability.metrics import WORKOUT_CACHE
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedWorkout:
+    """A user's workout as its projected document and a hash of its content, or no workout at all"""
+    workout_id: Optional[str]
+    document: Optional[Dict[str, Any]]
+    content_hash: Optional[str]
+    expires_at: float
+
+
+class CachedWorkoutRepository(WorkoutRepository):
+    """
+    Workout repository with a per-user read-through cache of the serialized workout, bounded by a TTL
+    and an LRU size. Writes through this repository invalidate the user's entry; with watch_changes,
+    a change stream does the same for writes made by other worker processes.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, ttl_seconds: float = 60, max_size: int = 10000,
+                 watch_changes: bool = False):
+        super().__init__(collection)
+        self.ttl = ttl_seconds
+        self.max_size = max_size
+        self.watch_changes = watch_changes
+        self._entries: OrderedDict[str, CachedWorkout] = OrderedDict()
+        self._users_by_workout: Dict[str, str] = {}
+        # bumped on every invalidation, so a read that raced a write does not cache what it read
+        self._generation = 0
+        self._watcher: Optional[asyncio.Task] = None
+
+    def _remember(self, user_id: str, entry: CachedWorkout):
+        self._forget(user_id)
+        self._entries[user_id] = entry
+        if entry.workout_id:
+            self._users_by_workout[entry.workout_id] = user_id
+        while len(self._entries) > self.max_size:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry and entry.workout_id:
+            self._users_by_workout.pop(entry.workout_id, None)
+
+    def invalidate(self, user_id: Optional[str] = None, workout_id: Optional[str] = None):
+        """Forgets the user's entry and the entry holding the workout, which may belong to another user"""
+        self._generation += 1
+        if workout_id and workout_id in self._users_by_workout:
+            self._forget(self._users_by_workout[workout_id])
+        if user_id:
+            self._forget(user_id)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._users_by_workout.clear()
+
+    def peek(self, user_id: str) -> Optional[CachedWorkout]:
+        """The user's cached entry if it is still fresh, without reading from Mongo"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._forget(user_id)
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    async def get_cached(self, user_id: str) -> CachedWorkout:
+        entry = self.peek(user_id)
+        if entry is not None:
+            WORKOUT_CACHE.labels(result="hit").inc()
+            return entry
+        WORKOUT_CACHE.labels(result="miss").inc()
+
+        generation = self._generation
+        workout = await self.get_document(user_id)
+        content_hash = hashlib.sha256(bson.encode(workout)).hexdigest()[:32] if workout else None
+        entry = CachedWorkout(workout["id"] if workout else None, workout, content_hash, time.monotonic() + self.ttl)
+        if generation == self._generation:
+            self._remember(user_id, entry)
+        return entry
+
+    async def add(self, workout: Workout, run_id: Optional[str] = None) -> str:
+        try:
+            return await super().add(workout, run_id)
+        finally:
+            self.invalidate(user_id=workout.user_id)
+
+    async def remove(self, workout_id: str) -> bool:
+        try:
+            return await super().remove(workout_id)
+        finally:
+            self.invalidate(workout_id=workout_id)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "replace", "update", "delete"]}}}]
+        delay = 1.0
+        while True:
+            try:
+                async with self.collection.watch(pipeline, full_document="updateLookup") as changes:
+                    # changes made while the stream was down were missed
+                    self.clear()
+                    delay = 1.0
+                    async for change in changes:
+                        # deletes carry only the documentKey, the workout id finds whose entry held it
+                        document = change.get("fullDocument") or {}
+                        self.invalidate(user_id=document.get("user_id"),
+                                        workout_id=str(change["documentKey"]["_id"]))
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as err:
+                logger.warning("workout change stream failed, retrying in %.0fs: %s", delay, err)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+
+    async def start(self):
+        if self.watch_changes:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
@@ -0,0 +1,59 @@
+import asyncio
+import argparse
+from collections import Counter
+from typing import List, Optional
+
+import main
+from agent.plan_cache import questionnaire_fingerprint
+from schema.model import Questionnaire
+
+
+WARMUP_USER_ID = "plan-cache-warmup"
+
+
+async def warmup(top: int, path: Optional[str], concurrency: int):
+    # nothing is served, the warm-up of the request path is not needed, and the warm-up's own lookups
+    # must not count towards the requests that pick what it warms
+    app = main.create_app(main.Settings(warmup_enabled=False, plan_cache_record_requests=False))
+    async with main.lifespan(app):
+        agent = app.state.agent
+        plan_cache = agent.plan_cache
+        if plan_cache is None:
+            raise SystemExit("plan cache is disabled, set PLAN_CACHE_ENABLED=true")
+
+        questionnaires: List[Questionnaire]
+        if path:
+            with open(path) as file:
+                questionnaires = [Questionnaire.model_validate_json(line) for line in file if line.strip()]
+        else:
+            # the requests are counted per planning mode, so a questionnaire can come up once per mode
+            questionnaires = list({questionnaire_fingerprint(questionnaire): questionnaire
+                                   for questionnaire in await plan_cache.plans.most_requested(top)}.values())
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def generate(questionnaire: Questionnaire) -> str:
+            if await plan_cache.get(questionnaire, agent.planning_mode):
+                return "cached"
+            try:
+                async with semaphore:
+                    workout_id = await agent.plan_workout_from_questionnaire(WARMUP_USER_ID, questionnaire)
+            except Exception as err:
+                print(f"failed to generate a plan for {questionnaire.model_dump(mode='json')}: {err!r}")
+                return "failed"
+            # only the template is kept, the warm-up user's copy is dropped
+            await app.state.workout_repository.remove(workout_id)
+            return "generated"
+
+        outcomes = Counter(await asyncio.gather(*(generate(questionnaire) for questionnaire in questionnaires)))
+        print(f"generated {outcomes['generated']} plans, {outcomes['cached']} already cached, "
+              f"{outcomes['failed']} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate cached workout plans for common questionnaires")
+    parser.add_argument("--top", type=int, default=50, help="number of most requested questionnaires to warm")
+    parser.add_argument("--file", help="NDJSON file of questionnaires to warm instead of the most requested ones")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(warmup(args.top, args.file, args.concurrency))